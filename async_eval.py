@@ -0,0 +1,92 @@
+"""Testing weight snapshots in a separate process while training goes on.
+
+With --async_eval, Trainer.train_network doesn't test the model after each
+epoch. It puts a copy of the model's state_dict in a queue and goes on with
+the next epoch. An evaluation process with its own test loaders (read from
+disk again by choose_loader) and --eval_threads CPU threads takes the
+snapshots in order, fills in the per-epoch test arrays, writes the per-image
+results, prints the test metrics and makes the plots. train_network joins it
+at the end and gets the test arrays and the last confusion matrices back, so
+what it returns is the same as with testing in between epochs.
+"""
+import copy
+import queue
+import torch
+import torch.multiprocessing as mp
+
+
+class AsyncEvaluator():
+    def __init__(self, trainer, results_writer):
+        config = trainer.config
+        ctx = mp.get_context('spawn')  # fork isn't safe once CUDA is initialised
+        # At most two snapshots wait, so training waits if testing falls behind
+        self.snapshots = ctx.Queue(maxsize=2)
+        self.results = ctx.Queue()
+        model = copy.deepcopy(trainer.model).cpu()
+        self.process = ctx.Process(target=eval_worker, args=(model, config, results_writer, self.snapshots, self.results))
+        self.process.start()
+        if config.device.type == 'cpu':
+            torch.set_num_threads(max(1, torch.get_num_threads() - config.eval_threads))
+
+    def submit(self, ep, model, train_curves=None):
+        """Queue a copy of model's weights to be tested as epoch ep, with the
+        (train_losses, train_accs) to plot for this epoch, if any."""
+        state_dict = {name: value.detach().to('cpu', copy=True) for name, value in model.state_dict().items()}
+        self.put((ep, state_dict, copy.deepcopy(train_curves)))
+
+    def join(self):
+        """Wait for the worker to test all snapshots. Returns its test arrays
+        and the confusion matrices of the last epoch."""
+        self.put(None)
+        while True:
+            try:
+                test_arrays, confs = self.results.get(timeout=10)
+                break
+            except queue.Empty:
+                self.check_alive()
+        self.process.join()
+        return test_arrays, confs
+
+    def put(self, item):
+        while True:
+            try:
+                self.snapshots.put(item, timeout=10)
+                return
+            except queue.Full:
+                self.check_alive()
+
+    def check_alive(self):
+        if not self.process.is_alive():
+            raise RuntimeError(f'Evaluation process exited with code {self.process.exitcode}')
+
+
+def eval_worker(model, config, results_writer, snapshots, results):
+    """Test the snapshots in the snapshots queue until it gets None."""
+    from loaders import choose_loader, cache_ventral_features
+    from trainers import choose_trainer
+    torch.set_num_threads(config.eval_threads)
+    config.save_act = False
+    loaders, test_xarray = choose_loader(config, test_only=True)
+    model.to(config.device)
+    if getattr(model, 'use_cached_features', False):
+        loaders = cache_ventral_features(model, loaders, config)
+    trainer = choose_trainer(model, loaders, test_xarray, config)
+    trainer.init_map_criteria()
+    test_arrays = trainer.new_test_arrays()
+    (test_loss, test_count_num_loss, test_count_map_loss, test_full_map_loss, test_sh_loss, test_acc_count, test_acc_map) = test_arrays
+    confs = None
+    while True:
+        snapshot = snapshots.get()
+        if snapshot is None:
+            break
+        ep, state_dict, train_curves = snapshot
+        model.load_state_dict(state_dict)
+        confs = trainer.evaluate(ep, test_arrays, results_writer)
+        print(f'Epoch {ep} (tested in background)')
+        trainer.print_test(ep, test_arrays)
+        if train_curves is not None:
+            train_losses, train_accs = train_curves
+            test_losses = (test_loss, test_count_num_loss, test_count_map_loss, test_sh_loss)
+            test_accs = (test_acc_count, test_acc_map)
+            trainer.plot_performance_quick(test_losses, test_accs, train_losses, train_accs, confs, ep + 1, config)
+    results.put((test_arrays, confs))
@@ -102,6 +102,22 @@ def get_config():
     parser.add_argument('--gpu', type=int, default=0, help='which gpu to use')
     parser.add_argument('--mult', action='store_true', default=False)
     parser.add_argument('--pass_penult', action='store_true', default=False)
+    parser.add_argument('--single_pass_eval', action='store_true', default=False, help='run the model on all test sets together each epoch instead of one test loader after the other')
+    parser.add_argument('--eval_batch_size', type=int, default=10000, help='most test images per model pass with --single_pass_eval')
+    parser.add_argument('--async_eval', action='store_true', default=False, help='test each epoch\'s weights in a separate process while training continues')
+    parser.add_argument('--eval_threads', type=int, default=4, help='CPU threads of the evaluation process with --async_eval')
+    parser.add_argument('--cache_ventral', action='store_true', default=False, help='precompute frozen ventral features for every glimpse once instead of every epoch')
+    parser.add_argument('--procedural', action='store_true', default=False, help='generate new training images on the fly every epoch instead of loading a stored training set')
+    parser.add_argument('--procedural_indexed', action='store_true', default=False, help='with --procedural, use a fixed training set whose images are regenerated from (seed, index) on demand')
+    parser.add_argument('--subset_view', type=str, default='balanced', help='how to take a smaller dataset from a bigger registered one: balanced (equal numbers per numerosity and distractor count) or prefix')
+    parser.add_argument('--virtual_glimpses', action='store_true', default=False, help='render logpolar glimpses for each batch from noised_image and glimpse_coords_image instead of loading logpolar_pixels')
+    parser.add_argument('--tensor_cache', action='store_true', default=False, help='store the loader tensors of each dataset as .npy files and memory-map them on later runs')
+    parser.add_argument('--shm_data', action='store_true', default=False, help='share loader tensors between training processes on this node through /dev/shm')
+    parser.add_argument('--batches_on_device', action='store_true', default=False, help='keep all in-memory loader tensors on the training device (for small inputs like symbolic or xy)')
+    parser.add_argument('--stream_data', action='store_true', default=False, help='read the training set from disk chunk by chunk instead of loading it into memory')
+    parser.add_argument('--stream_chunk', type=int, default=256, help='images per read with --stream_data')
+    parser.add_argument('--shuffle_buffer', type=int, default=2048, help='examples in the shuffle buffer of each worker with --stream_data')
+    parser.add_argument('--loader_workers', type=int, default=4, help='DataLoader worker processes for --procedural and --stream_data')
     parser.add_argument('--constant_contrast', action='store_true', default=False)
     parser.add_argument('--if_exists', type=str, default='ask', help='What to do if results for this config already exist? skip, force overwrite, or ask to increase rep counter.')
     config = parser.parse_args()
@@ -128,5 +144,9 @@ def get_config():
             config.test_shapes[j] = [letter_map[i] for i in test_set]
     if 'ventral' in config.model_type and config.no_pretrain:
         assert 'finetune' in config.model_type  # otherwise the params in the ventral module will never be trained!
+    if config.virtual_glimpses:
+        from loaders import pixel_loader_supported  # imports torch, only needed here
+        if not pixel_loader_supported(config):
+            parser.error(f'--virtual_glimpses only replaces logpolar_pixels/centre_fixation input, not {config.shape_input} with train_on={config.train_on} and {config.model_type}')
     print(config)
     return config
@@ -6,10 +6,13 @@ author: Jessica Thompson
 date: 2023-06-13
 """
 import os
+import json
+import shutil
 import argparse
 import numpy as np
 import pandas as pd
 import xarray as xr
+import netCDF4
 import torch
 from torch import nn
 from matplotlib import pyplot as plt
@@ -18,12 +21,27 @@ from sklearn.metrics.pairwise import euclidean_distances
 from scipy.spatial import distance
 from skimage.transform import warp_polar
 from itertools import product
+from collections import deque
 import random
 from math import isclose
-
-import symbolic_model as solver
-from letters import get_alphabet
-import utils
+from multiprocessing import Pool
+
+try:
+    # Imported as datasets.dataset_generator (eg by procedural.py)
+    from . import symbolic_model as solver
+    from .letters import get_alphabet
+    from .logpolar import LogPolarRenderer
+    from .quantization import quantize_pixels
+    from . import registry
+    from . import utils
+except ImportError:
+    # Run as a script from the repo root
+    import symbolic_model as solver
+    from letters import get_alphabet
+    from logpolar import LogPolarRenderer
+    from quantization import quantize_pixels
+    import registry
+    import utils
 
 
 class NoConvNet(nn.Module):
@@ -230,6 +248,109 @@ class DatasetGenerator():
             coords_glimpsed_objects = np.array(coords_glimpsed_objects)
         return glimpse_coords, glimpsed_objects, coords_glimpsed_objects, objects2count, distractors
     
+    def get_xy_coords_batch(self, nums, n_distract, noise_level, challenge, policy):
+        """Batched version of get_xy_coords for a block of images.
+
+        Draws object placements, glimpse-to-object assignments and the
+        (rejection-truncated to [0,1]^2) Gaussian jitter for all images at once.
+        Returns a list with the same per-image tuples as get_xy_coords.
+        """
+        nums = np.asarray(nums, dtype=int)
+        n_distract = np.asarray(n_distract, dtype=int)
+        n_images = len(nums)
+        n_symbols = len(self.possible_centroids)
+        nl = 0.1 * noise_level
+        rows = np.arange(n_images)[:, None]
+
+        if '+random' in challenge:
+            n_rand_gl = np.random.choice([0, 1, 2], size=n_images)
+            n_obj_glimpses = self.n_glimpses + 2 - n_rand_gl
+            # every image has n_glimpses + 2 glimpses, as in get_xy_coords,
+            # even if no image in the block draws 0 random glimpses
+            max_glimpses = self.n_glimpses + 2
+        else:
+            n_rand_gl = np.zeros(n_images, dtype=int)
+            n_obj_glimpses = np.full(n_images, self.n_glimpses)
+            max_glimpses = self.n_glimpses
+
+        # Random order of the slots in each image. Targets are the first num
+        # slots, distractors the next n_distract (ie sampled from the empty slots)
+        keys = np.random.random((n_images, n_symbols))
+        if 'corner' in challenge:
+            keys[:, 0] = np.inf
+        slot_order = np.argsort(keys, axis=1)
+        objects2count = [list(slot_order[i, :nums[i]]) for i in range(n_images)]
+        distractors = [[] for _ in range(n_images)]
+        if 'distract' in challenge:
+            if 'corner' in challenge:
+                distractors = [[0 for _ in range(n_distract[i])] for i in range(n_images)]
+            else:
+                distractors = [list(slot_order[i, nums[i]:nums[i] + n_distract[i]]) for i in range(n_images)]
+            if 'boost_target' in challenge:
+                all_objects = [objects2count[i] + distractors[i] + objects2count[i] for i in range(n_images)]
+                assert all(max_glimpses >= len(objs) for objs in all_objects)
+            elif 'only_target' in challenge:
+                all_objects = objects2count
+            else:
+                all_objects = [objects2count[i] + distractors[i] for i in range(n_images)]
+        else:
+            all_objects = objects2count
+
+        if policy == 'random':
+            glimpse_coords = np.random.uniform(0.05, 0.95, size=(n_images, self.n_glimpses, 2))
+            return [(glimpse_coords[i], np.full(self.n_glimpses, -1), [self.possible_centroids[0] for _ in range(self.n_glimpses)],
+                     objects2count[i], distractors[i]) for i in range(n_images)]
+
+        if policy == 'all_slots':
+            assert self.n_glimpses == n_symbols
+            glimpsed_objects = np.argsort(np.random.random((n_images, n_symbols)), axis=1)
+        else:
+            # Same candidate list as get_xy_coords: the objects in order, then
+            # the list is repeatedly doubled with a shuffled copy of itself, ie
+            # block b >= 1 is a random permutation of 2**(b-1) copies of each object
+            n_objects = np.array([len(objs) for objs in all_objects])
+            object_array = np.zeros((n_images, n_objects.max()), dtype=int)
+            for i, objs in enumerate(all_objects):
+                object_array[i, :len(objs)] = objs
+            glimpse_idx = np.arange(max_glimpses)
+            ratio = np.maximum(glimpse_idx / n_objects[:, None], 1)
+            block = np.where(glimpse_idx < n_objects[:, None], 0, np.floor(np.log2(ratio)).astype(int) + 1)
+            candidates = np.minimum(glimpse_idx, n_objects[:, None] - 1)
+            for b in range(1, block.max() + 1):
+                copies = 2**(b-1)
+                width = copies * n_objects.max()
+                perm_keys = np.random.random((n_images, width))
+                perm_keys = np.where(np.arange(width) >= copies * n_objects[:, None], np.inf, perm_keys)
+                perm = np.argsort(perm_keys, axis=1) % n_objects[:, None]
+                offset = np.clip(glimpse_idx - copies * n_objects[:, None], 0, width - 1)
+                candidates = np.where(block == b, perm[rows, offset], candidates)
+            candidates = object_array[rows, candidates]
+            # Keep the first n_obj_glimpses candidates and shuffle them
+            order_keys = np.random.random((n_images, max_glimpses))
+            order_keys[glimpse_idx >= n_obj_glimpses[:, None]] = np.inf
+            glimpsed_objects = candidates[rows, np.argsort(order_keys, axis=1)]
+        coords_glimpsed_objects = self.centroid_array[glimpsed_objects]
+
+        # Take noisy observations of glimpsed objects, redrawing any that fall
+        # outside of the 1x1 square
+        noise = np.random.normal(0, nl, size=coords_glimpsed_objects.shape)
+        glimpse_coords = coords_glimpsed_objects + noise
+        outside = np.any((glimpse_coords > 1) | (glimpse_coords < 0), axis=2)
+        while outside.any():
+            noise = np.random.normal(0, nl, size=(outside.sum(), 2))
+            glimpse_coords[outside] = coords_glimpsed_objects[outside] + noise
+            outside = np.any((glimpse_coords > 1) | (glimpse_coords < 0), axis=2)
+
+        # Add 0,1 or 2 random glimpses and shuffle the order of glimpses
+        if 'random' in challenge:
+            n_total = glimpse_coords.shape[1]
+            is_rand = np.arange(n_total) >= n_obj_glimpses[:, None]
+            glimpse_coords[is_rand] = np.random.uniform(0.05, 0.95, size=(is_rand.sum(), 2))
+            glimpse_coords = glimpse_coords[rows, np.argsort(np.random.random((n_images, n_total)), axis=1)]
+        glimpse_coords = glimpse_coords.astype(np.float32)
+        return [(glimpse_coords[i], glimpsed_objects[i, :n_obj_glimpses[i]], coords_glimpsed_objects[i, :n_obj_glimpses[i]],
+                 objects2count[i], distractors[i]) for i in range(n_images)]
+
     def calculate_proximity(self, glimpse_coords, item_coords, item_slots, shape_map):
         """Calculate proximity of fixation point to nearby item shape categories. 
         
@@ -333,8 +454,11 @@ class DatasetGenerator():
         # assert np.all(shape_coords.sum(axis=1) > 0)
         return shape_coords, shape_map, shape_hist
 
-    def generate_one_example(self, num, n_disract, n_unique, config):
-        """Synthesize a single toy glimpse sequence and apply symbolic solver."""
+    def generate_one_example(self, num, n_disract, n_unique, config, xy=None):
+        """Synthesize a single toy glimpse sequence and apply symbolic solver.
+
+        xy optionally holds this example's precomputed get_xy_coords output.
+        """
         same = config.same
         # distract = config.distract
         # rand_g = config.random
@@ -394,7 +518,9 @@ class DatasetGenerator():
         # TODO: Make this such that pass count range is only considered if included as cli argument. 
         # Otherwise, range set to be inclusive. That way don't need to bother with setting those cli arguments when not relevant
         # while final_pass_count < min_pass_count or final_pass_count > max_pass_count:
-        xy_coords, objects, noiseless_coords, to_count, distractors = self.get_xy_coords(num, n_disract, noise_level, challenge, policy)
+        if xy is None:
+            xy = self.get_xy_coords(num, n_disract, noise_level, challenge, policy)
+        xy_coords, objects, noiseless_coords, to_count, distractors = xy
         shape_coords, shape_map, shape_hist = self.get_shape_coords(xy_coords, shapes_set, same, to_count, distractors)
 
         # Initialize records
@@ -464,24 +590,20 @@ class DatasetGenerator():
                         }
         return example_dict
 
-    def generate_dataset(self, config):
-        """Fill data frame with toy examples."""
+    def get_schedule(self, config):
+        """Numerosity, number of distractors and number of unique shapes of
+        every image in a dataset of config.size images."""
         # numbers = np.arange(num_range[0], num_range[1] + 1)
         numbers = np.arange(config.min_num, config.max_num + 1)
         n_examples = config.size
         n_repeat = np.ceil(n_examples/len(numbers)).astype(int)
         nums = np.tile(numbers[::-1], n_repeat)
-        if 'distract012' in config.challenge:
-            n_distractor_set = [2, 1, 0]
+        if 'distract012' in config.challenge or 'distract123' in config.challenge:
+            n_distractor_set = distractor_set(config.challenge)
             # n_distractor_set = [3, 2, 1]
             n_repeat_d = np.ceil(n_examples/len(n_distractor_set)).astype(int)
             n_distract = np.repeat(n_distractor_set, n_repeat_d)
             n_unique = np.empty_like(nums) * np.nan
-        elif 'distract123' in config.challenge:
-            n_distractor_set = [3, 2, 1]
-            n_repeat_d = np.ceil(n_examples/len(n_distractor_set)).astype(int)
-            n_distract = np.repeat(n_distractor_set, n_repeat_d)
-            n_unique = np.empty_like(nums) * np.nan
         elif 'unique' in config.challenge:
             n_distract = np.zeros_like(nums)
             n_unique_set = [1, 2, 3]
@@ -494,18 +616,61 @@ class DatasetGenerator():
         else:
             n_distract = np.zeros_like(nums)
             n_unique = np.empty_like(nums) * np.nan
+        return nums, n_distract, n_unique
+
+    def generate_dataset(self, config, start=0, stop=None):
+        """Fill data frame with toy examples.
 
+        start and stop select a range of image indices out of the full dataset
+        of config.size images (used for sharded generation).
+        """
+        nums, n_distract, n_unique = self.get_schedule(config)
+        n_examples = config.size
+        stop = n_examples if stop is None else stop
+        if config.xy_sampler == 'batched':
+            xy_block = self.get_xy_coords_batch(nums[start:stop], n_distract[start:stop], config.noise_level, config.challenge, config.policy)
         # data = [self.generate_one_example(nums[i], n_distract[i], n_unique[i], config) for i in range(n_examples)]
         data = []
-        for i in range(n_examples):
+        for i in range(start, stop):
             if not i % 10:
                 print(f'Generating info for image {i}', end='\r')
-            example = self.generate_one_example(nums[i], n_distract[i], n_unique[i], config)
+            xy = xy_block[i - start] if config.xy_sampler == 'batched' else None
+            example = self.generate_one_example(nums[i], n_distract[i], n_unique[i], config, xy)
             data.append(example)
         # data = [generate_one_example(nums[i], noise_level, pass_count_range, num_range, shapes_set, n_shapes, same) for i in range(n_examples)]
         df = pd.DataFrame(data)
         return df
     
+    def generate_keyed(self, indices, config, seed):
+        """Generate the images with the given indices out of a dataset of
+        config.size images, seeding every random draw for image i (placement,
+        shapes, jitter, luminances and noise) from image_seed(seed, i).
+
+        Image i is therefore identical no matter which other images are
+        generated with it or in what order.
+        """
+        nums, n_distract, n_unique = self.get_schedule(config)
+        examples = []
+        noised = []
+        luminances = []
+        for i in indices:
+            image_rng_seed = image_seed(seed, i)
+            random.seed(image_rng_seed)
+            np.random.seed([image_rng_seed & 0xffffffff, image_rng_seed >> 32])
+            example = self.generate_one_example(nums[i], n_distract[i], n_unique[i], config)
+            shape_map = np.zeros((1, self.grid_size))
+            for slot, shape in example['shape_map'].items():
+                shape_map[0, slot] = shape
+            image, lums = self.synthesize_images(np.array([example['locations']]), shape_map, config.luminances, config.constant_contrast)
+            examples.append(example)
+            noised.append(image)
+            luminances.append(lums)
+        data_pd = pd.DataFrame(examples)
+        data, data_pd = self.add_logpolar_glimpses_xr(data_pd, config, np.concatenate(noised), np.concatenate(luminances))
+        data = data.assign_coords(image=np.asarray(indices))
+        data_pd.index = pd.Index(indices)
+        return data, data_pd
+
     def pandas_to_xr(self, df):
         """Convert pandas DataFrame to Xarray Dataset."""
         def get_stackable_shape_map(shape_map):
@@ -579,6 +744,51 @@ class DatasetGenerator():
         noised = np.float32(noised)
         return noised
 
+    def synthesize_images(self, locations, shape_maps, lums, constant_contrast):
+        """Batched version of the letter stamping, luminance sampling and
+        get_solarized_noise steps of add_logpolar_glimpses_xr.
+
+        Args:
+            locations (array): (n_images, 36) which slots are filled
+            shape_maps (array): (n_images, 36) shape index of each filled slot
+            lums (list): luminance values to sample fg/bg pairs from
+            constant_contrast (bool): require |fg - bg| == 0.3 instead of >= 0.2
+
+        Returns:
+            array: (n_images, 48, 42) noised images including the border
+            array: (n_images, 2) fg and bg luminances
+        """
+        glim_wid = 6
+        half_glim = glim_wid//2
+        n_images = len(locations)
+        atlas = np.array(get_alphabet(), dtype=np.float32)
+        topleft = np.array(self.pixel_topleft)  # x, y of each slot
+
+        # Stamp all letters at once
+        images = np.zeros((n_images, self.pixel_height + glim_wid, self.pixel_width + glim_wid), dtype=np.float32)
+        image_idx, slots = np.nonzero(locations)
+        shapes = shape_maps[image_idx, slots].astype(int)
+        rows = topleft[slots, 1, None, None] + half_glim + np.arange(self.char_height)[:, None]
+        cols = topleft[slots, 0, None, None] + half_glim + np.arange(self.char_width)[None, :]
+        images[image_idx[:, None, None], rows, cols] = atlas[shapes]
+
+        # Sample uniformly from the valid (fg, bg) pairs, which is what the
+        # rejection loop does
+        pairs = np.array([(lums[i], lums[j]) for i, j in product(range(len(lums)), repeat=2) if i != j])
+        if constant_contrast:
+            valid = [isclose(abs(fg - bg), 0.3) for fg, bg in pairs]
+        else:
+            valid = [abs(fg - bg) >= 0.2 for fg, bg in pairs]
+        pairs = pairs[np.array(valid, dtype=bool)]
+        if len(pairs) == 0:
+            raise ValueError(f'No valid foreground/background pair in luminances {lums}')
+        fg_bg = pairs[np.random.randint(len(pairs), size=n_images)]
+
+        # Solarize and add Gaussian noise
+        solarized = np.where(images == 1, fg_bg[:, 0, None, None], fg_bg[:, 1, None, None])
+        noised = np.float32(np.random.normal(loc=solarized, scale=0.05))
+        return noised, fg_bg
+
     # def add_logpolar_glimpses_pandas(self, data, conf):
     #     """Synthesize and glimpse images from symbolic description."""
     #     glim_wid = conf.glimpse_wid
@@ -676,7 +886,38 @@ class DatasetGenerator():
 
         return human_like_glimpse_coords
 
-    def add_logpolar_glimpses_xr(self, data_pd, conf):
+    def allocate_glimpse_buffers(self, n_images, conf):
+        """Plain numpy arrays (or .npy memmaps in conf.buffer_dir) for every
+        variable added by add_logpolar_glimpses_xr, with their xarray dims."""
+        imsize_wbord = (self.pixel_height + 6, self.pixel_width + 6)
+        specs = {
+            'glimpse_coords_image': (("image", "glimpse", "coordinate"), (self.n_glimpses, 2), np.float32),
+            'glimpse_coords_scaled': (("image", "glimpse", "coordinate"), (self.n_glimpses, 2), np.float32),
+            'glimpse_coords_humanlike': (("image", "glimpse", "coordinate"), (self.n_glimpses, 2), np.float32),
+            'symbolic_shape_humanlike': (("image", "glimpse", "character"), (self.n_glimpses, self.n_shapes), np.float32),
+            'luminances': (("image", "ground"), (2,), np.float64),
+            'noised_image': (("image", "row", "column"), imsize_wbord, np.float32),
+            'centre_fixation': (("image", "row", "column"), imsize_wbord, np.float32),
+            'logpolar_pixels': (("image", "glimpse", "row", "column"), (self.n_glimpses,) + imsize_wbord, np.float32),
+            # 'logpolar_pixels_humanlike': (("image", "glimpse", "row", "column"), (self.n_glimpses,) + imsize_wbord, np.float32),
+        }
+        buffers = {}
+        for name, (dims, shape, dtype) in specs.items():
+            shape = (n_images,) + shape
+            if conf.buffer_dir is not None:
+                os.makedirs(conf.buffer_dir, exist_ok=True)
+                array = np.lib.format.open_memmap(f'{conf.buffer_dir}/{name}.npy', mode='w+', dtype=dtype, shape=shape)
+            else:
+                array = np.zeros(shape, dtype=dtype)
+            buffers[name] = (dims, array)
+        return buffers
+
+    def add_logpolar_glimpses_xr(self, data_pd, conf, noised_images=None, luminances=None):
+        """Synthesize the images described in data_pd and their glimpses.
+
+        noised_images and luminances can be passed in if the images were
+        already synthesized (see generate_keyed).
+        """
         print('\n Adding logpolar glimpses...')
         if conf.policy == 'humanlike':
             # Load generative model of human fixations
@@ -693,126 +934,358 @@ class DatasetGenerator():
         n_images = len(data.image)
         image_size_nobord = [self.pixel_height, self.pixel_width]
         imsize_wbord = [self.pixel_height+glim_wid, self.pixel_width+glim_wid]
-        data['glimpse_coords_image'] = (("image", "glimpse", "coordinate"), np.empty((n_images, self.n_glimpses, 2), dtype=np.float32))
-        data['glimpse_coords_scaled'] = (("image", "glimpse", "coordinate"), np.empty((n_images, self.n_glimpses, 2), dtype=np.float32))
-        data['glimpse_coords_humanlike'] = (("image", "glimpse", "coordinate"), np.empty((n_images, self.n_glimpses, 2), dtype=np.float32))
-        data['symbolic_shape_humanlike'] = (("image", "glimpse", "character"), np.empty((n_images, self.n_glimpses, self.n_shapes), dtype=np.float32))
-
-        data['luminances'] = (("image", "ground"), np.empty((n_images, 2)))
-        data['noised_image'] = (("image", "row", "column"), np.empty((n_images, 48, 42), dtype=np.float32))
-        data['centre_fixation'] =(("image", "row", "column"), np.empty((n_images, 48, 42), dtype=np.float32))
-        data['logpolar_pixels'] = (("image", "glimpse", "row", "column"), np.empty((n_images, self.n_glimpses, 48, 42), dtype=np.float32))
-
-        # data['logpolar_pixels_humanlike'] = (("image", "glimpse", "row", "column"), np.empty((n_images, self.n_glimpses, 48, 42), dtype=np.float32))
+        # Fill plain arrays and only wrap them into the Dataset at the end
+        buffers = self.allocate_glimpse_buffers(n_images, conf)
+        out = {name: array for name, (dims, array) in buffers.items()}
+        locations = data['locations'].values
+        locations_count = data['locations_count'].values
+        locations_distract = data['locations_distract'].values
+        shape_maps = data['shape_map'].values
+        all_glimpse_coords_1x1 = data['glimpse_coords_1x1'].values
             
-        data_pd['target_coords_scaled'] = []
-        data_pd['distract_coords_scaled'] = []
+        presynthesized = conf.synthesis == 'batched' or noised_images is not None
+        if noised_images is not None:
+            out['noised_image'][:] = noised_images
+            out['luminances'][:] = luminances
+        elif conf.synthesis == 'batched':
+            # Fixed batch size so the random stream only depends on the seed
+            batch_size = 1000
+            for start in range(0, n_images, batch_size):
+                stop = min(start + batch_size, n_images)
+                noised_batch, lum_batch = self.synthesize_images(locations[start:stop], shape_maps[start:stop], lums, conf.constant_contrast)
+                out['noised_image'][start:stop] = noised_batch
+                out['luminances'][start:stop] = lum_batch
+
+        all_target_coords_scaled = []
+        all_distract_coords_scaled = []
         for i in range(n_images):
             if not i % 10:
                 print(f'Synthesizing image {i}', end='\r')
-            row_pd = data_pd.iloc[i]
-            row = data.isel(image=i)
             
             # PREPARE IMAGE
             # Get coordinates of items
-            slots =  np.where(row.locations.values)[0]
+            slots =  np.where(locations[i])[0]
             object_xy_coords = self.centroid_array[slots]
 
-            object_pixel_coords = [self.map_scale_pixel[tuple(xy)] for xy in object_xy_coords] # Where to insert letters
-            # Shape indices for the objects
-            object_shapes = [row_pd['shape_map'][obj] for obj in slots]
-
-            # Insert the specified shapes into the image at the specified locations
-            image = np.zeros(image_size_nobord, dtype=np.float32)
-            for shape_idx, (x,y) in zip(object_shapes, object_pixel_coords):
-                image[y:y+self.char_height:, x:x+self.char_width] = chars[shape_idx]
-
-            # Add small border to image (3 pixels on all sides)
-            image_wbord = np.zeros(imsize_wbord, dtype=np.float32)
-            image_wbord[half_glim:-half_glim,half_glim:-half_glim] = image
-            # Solarize and add Gaussian noise to image
-            fg, bg = np.random.choice(lums, size=2, replace=False)
-            # ensure that the difference between the foreground and background
-            # is at least 0.2, which is the smallest difference in the test sets
-            if conf.constant_contrast:
-                while not isclose(abs(fg - bg), 0.3):
-                    fg, bg = np.random.choice(lums, size=2, replace=False)
-            else: 
-                while abs(fg - bg) < 0.2:
-                    fg, bg = np.random.choice(lums, size=2, replace=False)
-            # data.at[i, 'luminances'] = [fg, bg]
-            data['luminances'].loc[dict(image=i)] = [fg, bg]
-            noised = self.get_solarized_noise(image_wbord, fg, bg)
-            # data.at[i, 'noised_image'] = noised
-            data['noised_image'].loc[dict(image=i)] = noised
+            if presynthesized:
+                noised = out['noised_image'][i]
+            else:
+                object_pixel_coords = [self.map_scale_pixel[tuple(xy)] for xy in object_xy_coords] # Where to insert letters
+                # Shape indices for the objects
+                object_shapes = [int(shape_maps[i, obj]) for obj in slots]
+
+                # Insert the specified shapes into the image at the specified locations
+                image = np.zeros(image_size_nobord, dtype=np.float32)
+                for shape_idx, (x,y) in zip(object_shapes, object_pixel_coords):
+                    image[y:y+self.char_height:, x:x+self.char_width] = chars[shape_idx]
+
+                # Add small border to image (3 pixels on all sides)
+                image_wbord = np.zeros(imsize_wbord, dtype=np.float32)
+                image_wbord[half_glim:-half_glim,half_glim:-half_glim] = image
+                # Solarize and add Gaussian noise to image
+                fg, bg = np.random.choice(lums, size=2, replace=False)
+                # ensure that the difference between the foreground and background
+                # is at least 0.2, which is the smallest difference in the test sets
+                if conf.constant_contrast:
+                    while not isclose(abs(fg - bg), 0.3):
+                        fg, bg = np.random.choice(lums, size=2, replace=False)
+                else: 
+                    while abs(fg - bg) < 0.2:
+                        fg, bg = np.random.choice(lums, size=2, replace=False)
+                out['luminances'][i] = [fg, bg]
+                noised = self.get_solarized_noise(image_wbord, fg, bg)
+                out['noised_image'][i] = noised
             
             # PREPARE COORDINATES
             # Get target and distractor coordinates in the same scaled frame of 
             # reference as the glimpse coords. Important for analysis of 
             # activations and eye tracking.
-            target_slots = np.where(row_pd['locations_count'])[0]
+            target_slots = np.where(locations_count[i])[0]
             target_coords_1x1 = self.centroid_array[target_slots]
             # target_coords_image = (target_coords_1x1 * image_size_nobord[::-1]) + half_glim
             target_coords_image = np.array([self.map_scale_pixel[tuple(xy)]for xy in target_coords_1x1]) + half_glim 
             target_coords_image = target_coords_image + [(self.char_width/2) - 0.5, (self.char_height/2) - 0.5]
             target_coords_scaled = target_coords_image/imsize_wbord[::-1]
-            data_pd.at[i, 'target_coords_scaled'] = target_coords_scaled
+            all_target_coords_scaled.append(target_coords_scaled)
             
-            distract_slots = np.where(row_pd['locations_distract'])[0]
+            distract_slots = np.where(locations_distract[i])[0]
+            distract_coords_scaled = None
             if len(distract_slots) > 0:
                 distract_coords_1x1 = self.centroid_array[distract_slots]
                 # distract_coords_image = (distract_coords_1x1 * image_size_nobord[::-1]) + half_glim
                 distract_coords_image = np.array([self.map_scale_pixel[tuple(xy)]for xy in distract_coords_1x1]) + half_glim 
                 distract_coords_image = distract_coords_image + [(self.char_width/2) - 0.5, (self.char_height/2) - 0.5]
                 distract_coords_scaled = distract_coords_image/imsize_wbord[::-1]
-                data_pd.at[i, 'distract_coords_scaled'] = distract_coords_scaled
+            all_distract_coords_scaled.append(distract_coords_scaled)
                 
             # Convert 1x1 glimpse coordinates of glimpse and locations to pixel 
             # coordinates and scale between 0 and 1 (because of image border)
-            glimpse_coords_1x1 = row.glimpse_coords_1x1.values.copy()
+            glimpse_coords_1x1 = all_glimpse_coords_1x1[i]
             glimpse_coords_image = np.multiply(glimpse_coords_1x1, image_size_nobord[::-1]) + half_glim
             glimpse_coords_image = np.round(glimpse_coords_image).astype(int)
-            # data.at[i, 'glimpse_coords'] = glimpse_coords
-            data['glimpse_coords_image'].loc[dict(image=i)] = glimpse_coords_image
-            data['glimpse_coords_scaled'].loc[dict(image=i)] = np.divide(glimpse_coords_image, imsize_wbord[::-1])
+            out['glimpse_coords_image'][i] = glimpse_coords_image
+            out['glimpse_coords_scaled'][i] = np.divide(glimpse_coords_image, imsize_wbord[::-1])
             
             # PREPARE GLIMPSE CONTENTS
             if conf.policy == 'humanlike':
                 # **Get humanlike glimpse coordinates**
                 # Prepare the input features for the generative model
-                locations_count_T = utils.transpose(row.locations_count.values)
-                locations_distract_T = utils.transpose(row.locations_distract.values)
+                locations_count_T = utils.transpose(locations_count[i])
+                locations_distract_T = utils.transpose(locations_distract[i])
                 fixator_features = np.array(locations_count_T) + 0.5*np.array(locations_distract_T)
                 features = torch.from_numpy(fixator_features).float()
         
                 # Use pretained generative model to produce humanlike fixation heatmaps
                 _, smooth_map = fixator(features.unsqueeze(0))
                 humanlike_coords = self.sample_from_smooth_map(smooth_map)
-                data['glimpse_coords_humanlike'].loc[dict(image=i)] = humanlike_coords
+                out['glimpse_coords_humanlike'][i] = humanlike_coords
                             
                 # Calculate shape proximity vector for humanlike glimpses
                 max_dist = self.max_dist
-                shape_coords = self.calculate_proximity(humanlike_coords, object_xy_coords, slots, row_pd.shape_map, max_dist)
-                data["symbolic_shape_humanlike"].loc[dict(image=i)] = shape_coords
+                shape_coords = self.calculate_proximity(humanlike_coords, object_xy_coords, slots, shape_maps[i].astype(int), max_dist)
+                out['symbolic_shape_humanlike'][i] = shape_coords
                 
+            if conf.renderer == 'batched':
+                continue  # all glimpses are rendered below
+            if conf.policy == 'humanlike':
                 # Warp noised image to generate log-polar glimpses
                 # radius defaults to include the whole image np.sqrt(w/2**2 + h/2**2)
                 lp_glimpses = [warp_polar(noised, scaling=conf.scaling, output_shape=imsize_wbord, center=(y*48, x*48), mode='edge') for x, y in humanlike_coords]
             else:
                 # Warp noised image to generate log-polar glimpses
                 lp_glimpses = [warp_polar(noised, scaling=conf.scaling, output_shape=imsize_wbord, center=(y, x), mode='edge') for x, y in glimpse_coords_image]
-            # data.at[i, 'logpolar_pixels'] = lp_glimpses
-            data['logpolar_pixels'].loc[dict(image=i)] = lp_glimpses
+            out['logpolar_pixels'][i] = lp_glimpses
             
             # Fixed gaze at the centre
             centre = [size//2 for size in imsize_wbord]
             fixation = warp_polar(noised, scaling='log', output_shape=imsize_wbord, center=centre, mode='edge')  # rows, cols
-            # data.at[i, 'centre_fixation'] = fixation
-            data['centre_fixation'].loc[dict(image=i)] = fixation
+            out['centre_fixation'][i] = fixation
 
+        if conf.renderer == 'batched':
+            self.render_glimpses_batched(out, conf, imsize_wbord)
+        data = data.assign(buffers)
+        data_pd['target_coords_scaled'] = all_target_coords_scaled
+        data_pd['distract_coords_scaled'] = all_distract_coords_scaled
         return data, data_pd
-    
-    
+
+    def render_glimpses_batched(self, out, conf, imsize_wbord, batch_size=1000):
+        """Same output as the warp_polar calls in add_logpolar_glimpses_xr, but
+        with cached sampling plans and one gather per batch of images."""
+        print('\n Rendering logpolar glimpses in batches...')
+        renderer = LogPolarRenderer(imsize_wbord, imsize_wbord, conf.scaling)
+        centre_renderer = renderer if conf.scaling == 'log' else LogPolarRenderer(imsize_wbord, imsize_wbord, 'log')
+        centre = [size//2 for size in imsize_wbord]
+        noised = out['noised_image']
+        n_images = len(noised)
+        if conf.policy == 'humanlike':
+            xy = out['glimpse_coords_humanlike'] * 48
+        else:
+            xy = out['glimpse_coords_image']
+        centres = xy[..., ::-1]  # (x, y) -> (row, col)
+        for start in range(0, n_images, batch_size):
+            stop = min(start + batch_size, n_images)
+            out['logpolar_pixels'][start:stop] = renderer.render(noised[start:stop], centres[start:stop])
+            centre_batch = np.tile(centre, (stop - start, 1, 1))
+            out['centre_fixation'][start:stop] = centre_renderer.render(noised[start:stop], centre_batch)[:, 0]
+
+
+def distractor_set(challenge):
+    """Numbers of distractors in the images of a distract012/distract123
+    challenge, in schedule order (see DatasetGenerator.get_schedule)."""
+    if 'distract012' in challenge:
+        return [2, 1, 0]
+    elif 'distract123' in challenge:
+        return [3, 2, 1]
+    raise ValueError(f'No distractor set for challenge {challenge}')
+
+
+def image_seed(seed, index):
+    """64 bit seed for image index, from a counter-based RNG (Philox keyed by
+    seed, with the image index as counter). Kept at 64 bits because 32 bit
+    seeds collide every ~100k images, giving identical images."""
+    bit_generator = np.random.Philox(key=seed, counter=[index, 0, 0, 0])
+    return int(bit_generator.random_raw())
+
+
+def shard_seed(seed, shard_id):
+    """Seed for one shard, derived from (seed, shard_id) only."""
+    return int(np.random.SeedSequence([seed, shard_id]).generate_state(1)[0])
+
+
+def generate_shard(args):
+    """Generate images start:stop of the dataset in a worker process.
+
+    The RNGs are reseeded per shard so the output only depends on --seed and
+    --shard_size, not on how many workers are used.
+    """
+    conf, shard_id, start, stop = args
+    if conf.buffer_dir is not None:
+        conf = argparse.Namespace(**vars(conf))
+        conf.buffer_dir = f'{conf.buffer_dir}/shard{shard_id}'
+    generator = DatasetGenerator(conf)
+    seed = shard_seed(conf.seed, shard_id)
+    random.seed(seed)
+    np.random.seed(seed)
+    toydata = generator.generate_dataset(conf, start, stop)
+    data, data_pd = generator.add_logpolar_glimpses_xr(toydata, conf)
+    # Global image indices so the shards can be concatenated
+    data = data.assign_coords(image=np.arange(start, stop))
+    data_pd.index = pd.RangeIndex(start, stop)
+    return data, data_pd
+
+
+def shard_jobs(conf):
+    """(conf, shard_id, start, stop) for every shard of conf.shard_size images."""
+    bounds = list(range(0, conf.size, conf.shard_size)) + [conf.size]
+    return [(conf, shard_id, start, stop) for shard_id, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:]))]
+
+
+def run_shards(conf, jobs):
+    """Yield generated shards in order, using a pool if conf.workers > 1.
+
+    At most conf.workers shards are submitted ahead of the one being
+    consumed, so no more than conf.workers + 1 shards are in memory at once
+    (pool.imap would keep generating while the consumer writes).
+    """
+    print(f'Generating {conf.size} images in {len(jobs)} shards with {conf.workers} workers')
+    if conf.workers == 1:
+        for job in jobs:
+            yield generate_shard(job)
+    else:
+        with Pool(conf.workers) as pool:
+            jobs = iter(jobs)
+            pending = deque(pool.apply_async(generate_shard, (job,)) for _, job in zip(range(conf.workers), jobs))
+            while pending:
+                shard = pending.popleft().get()
+                job = next(jobs, None)
+                if job is not None:
+                    pending.append(pool.apply_async(generate_shard, (job,)))
+                yield shard
+
+
+def generate_sharded(conf):
+    """Split the image range into shards of conf.shard_size and generate
+    them in a pool of conf.workers processes, then merge."""
+    shards = list(run_shards(conf, shard_jobs(conf)))
+    data = xr.concat([shard[0] for shard in shards], dim='image')
+    data_pd = pd.concat([shard[1] for shard in shards])
+    return data, data_pd
+
+
+class NetCDFStreamWriter():
+    """Append image chunks to a NetCDF4 file with an unlimited image dimension.
+
+    The first chunk is written with xarray (which sets up dims, coords, attrs
+    and encodings), later chunks are appended with netCDF4 directly. Every
+    image variable is chunked as (chunk_images, <full other dims>) so that
+    loaders.get_dataset reads it sequentially.
+    """
+    def __init__(self, filename, chunk_images=64, complevel=0):
+        self.filename = filename
+        self.chunk_images = chunk_images
+        self.complevel = complevel
+        self.n_written = 0
+
+    def encoding(self, data):
+        encoding = {}
+        for name, var in data.data_vars.items():
+            if 'image' not in var.dims:
+                continue
+            chunks = tuple(self.chunk_images if dim == 'image' else size for dim, size in zip(var.dims, var.shape))
+            encoding[name] = {'chunksizes': chunks}
+            if self.complevel > 0:
+                encoding[name].update({'zlib': True, 'complevel': self.complevel})
+        return encoding
+
+    def append(self, data):
+        n_images = len(data.image)
+        if self.n_written == 0:
+            data.to_netcdf(self.filename, unlimited_dims=['image'], encoding=self.encoding(data))
+        else:
+            with netCDF4.Dataset(self.filename, 'a') as nc:
+                nc.set_auto_maskandscale(False)  # data is already packed (see quantization.py)
+                stop = self.n_written + n_images
+                nc['image'][self.n_written:stop] = data['image'].values
+                for name, var in data.data_vars.items():
+                    if 'image' in var.dims:
+                        nc[name][self.n_written:stop] = var.values
+        self.n_written += n_images
+
+
+def write_json(obj, filename):
+    """Write via a temporary file so a crash never leaves half a file."""
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(obj, f, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+
+def check_progress(progress, filename):
+    """Make the completed shards in progress agree with the images in filename.
+
+    Shards are completed in order and progress is saved after each append, so
+    a crash during an append leaves images past the last completed shard in
+    the file (they are overwritten when that shard is redone). Completed shards
+    that are missing from the file are dropped so they are generated again.
+    """
+    n_completed = sum(shard['stop'] - shard['start'] for shard in progress['completed'])
+    if not os.path.exists(filename):
+        n_in_file = 0
+    else:
+        with netCDF4.Dataset(filename) as nc:
+            n_in_file = len(nc.dimensions['image'])
+    if n_in_file < n_completed:
+        print(f'{filename} has {n_in_file} of the {n_completed} images of the completed shards, redoing the missing shards')
+        progress['completed'] = [shard for shard in progress['completed'] if shard['stop'] <= n_in_file]
+    elif n_in_file > n_completed:
+        print(f'{filename} has {n_in_file - n_completed} images past the last completed shard (interrupted append), they will be overwritten')
+
+
+def generate_streaming(conf, filename):
+    """Generate shards and append each one to filename as soon as it is done,
+    so memory is bounded by a few shards (see run_shards) instead of conf.size.
+
+    After every shard the completed range and its seed are recorded in
+    filename.progress.json (and the shard's metadata in a _parts directory), so
+    that --resume can continue from the first unfinished shard. Since each
+    shard's RNG only depends on (seed, shard_id), the result is identical to
+    an uninterrupted run.
+
+    Returns the (image-free) pandas metadata of the whole set.
+    """
+    progress_file = filename + '.progress.json'
+    parts_dir = filename[:-len('.nc')] + '_parts'
+    os.makedirs(parts_dir, exist_ok=True)
+    settings = {key: value for key, value in sorted(vars(conf).items()) if key not in ['workers', 'resume', 'stream']}
+    progress = {'settings': settings, 'completed': []}
+    if conf.resume and os.path.exists(progress_file):
+        with open(progress_file) as f:
+            saved = json.load(f)
+        if saved['settings'] != json.loads(json.dumps(settings)):
+            raise ValueError(f'{progress_file} was written with different settings, cannot resume')
+        progress = saved
+        check_progress(progress, filename)
+        print(f"Resuming after {len(progress['completed'])} completed shards")
+
+    writer = NetCDFStreamWriter(filename, conf.chunk_images, conf.complevel)
+    done = [shard['shard_id'] for shard in progress['completed']]
+    writer.n_written = sum(shard['stop'] - shard['start'] for shard in progress['completed'])
+    jobs = [job for job in shard_jobs(conf) if job[1] not in done]
+    for (_, shard_id, start, stop), (data, shard_pd) in zip(jobs, run_shards(conf, jobs)):
+        if conf.quantize is not None:
+            data = quantize_pixels(data, conf.quantize)
+        writer.append(data)
+        shard_pd.to_pickle(f'{parts_dir}/shard{shard_id}.pkl')
+        progress['completed'].append({'shard_id': shard_id, 'start': start, 'stop': stop,
+                                      'seed': shard_seed(conf.seed, shard_id)})
+        write_json(progress, progress_file)
+        print(f'Wrote {writer.n_written}/{conf.size} images to {filename}')
+
+    data_pd = pd.concat([pd.read_pickle(f'{parts_dir}/shard{job[1]}.pkl') for job in shard_jobs(conf)])
+    shutil.rmtree(parts_dir)
+    os.remove(progress_file)
+    return data_pd
+
+
 def process_args(conf):
     """Set global variables and convert strings to ints."""
     if conf.shapes[0].isnumeric():
@@ -855,6 +1328,17 @@ def main():
     # parser.add_argument('--random', action='store_true', default=False)
     parser.add_argument('--n_glimpses', type=int, default=12, help='how many glimpses to generate per image')
     parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=0, help='Generate in shards with this many processes. 0 to generate everything in one pass (legacy seeding).')
+    parser.add_argument('--shard_size', type=int, default=1000, help='Images per shard when --workers > 0. Shard seeds depend on this, not on --workers')
+    parser.add_argument('--xy_sampler', type=str, default='loop', help='loop (get_xy_coords per image) or batched (get_xy_coords_batch per shard)')
+    parser.add_argument('--synthesis', type=str, default='loop', help='loop (per image) or batched (synthesize_images on 1000 images at a time)')
+    parser.add_argument('--stream', action='store_true', default=False, help='Append each shard to the .nc file as it is generated (requires --workers > 0)')
+    parser.add_argument('--resume', action='store_true', default=False, help='Continue an interrupted --stream run from its last completed shard')
+    parser.add_argument('--chunk_images', type=int, default=64, help='NetCDF chunk size along the image dim when streaming')
+    parser.add_argument('--complevel', type=int, default=0, help='zlib compression level when streaming, 0 for none')
+    parser.add_argument('--buffer_dir', type=str, default=None, help='Fill memory-mapped .npy buffers in this directory instead of in-RAM arrays (for big sets)')
+    parser.add_argument('--quantize', type=str, default=None, choices=['uint8', 'int16'], help='Store the pixel variables in 8 or 16 bits (see quantization.py)')
+    parser.add_argument('--renderer', type=str, default='skimage', help='skimage (one warp_polar call per glimpse) or batched (cached sampling plans, see logpolar.py)')
     conf = parser.parse_args()
 
     same = 'same' if conf.same else ''
@@ -879,16 +1363,23 @@ def main():
     trunc = 'trunc' if conf.truncate else ''
     logscale = '_logscale' if conf.logscale else ''
 
-    # define_globals(conf)
-    generator = DatasetGenerator(conf)
-    toydata = generator.generate_dataset(conf)  # Generate toy version, apply symbolic model
-    # data = generator.add_logpolar_glimpses_pandas(toydata, conf)
-    data, data_pd = generator.add_logpolar_glimpses_xr(toydata, conf)
-    
     dirname = 'datasets/image_sets'
     fname_gw = f'{dirname}/num{conf.min_num}-{conf.max_num}_nl-{conf.noise_level}{trunc}{logscale}_{shapes}{same}{challenge}_grid{conf.grid}_policy-{policy}_lum{conf.luminances}_{transform}{n_glimpses}{conf.size}'
     if not os.path.isdir(fname_gw):
             os.makedirs(fname_gw)
+
+    # define_globals(conf)
+    if conf.stream or conf.resume:
+        assert conf.workers > 0, '--stream writes shards, set --workers'
+        data_pd = generate_streaming(conf, fname_gw + '.nc')
+        data = xr.open_dataset(fname_gw + '.nc')  # lazy, only used for the example images below
+    elif conf.workers > 0:
+        data, data_pd = generate_sharded(conf)
+    else:
+        generator = DatasetGenerator(conf)
+        toydata = generator.generate_dataset(conf)  # Generate toy version, apply symbolic model
+        # data = generator.add_logpolar_glimpses_pandas(toydata, conf)
+        data, data_pd = generator.add_logpolar_glimpses_xr(toydata, conf)
             
     # Save example images for viewing
     sample = np.random.choice(np.arange(len(data.image)), 10)
@@ -919,8 +1410,19 @@ def main():
     # data['logpolar_pixels'] /= data['logpolar_pixels'].max()
     # WE WANT TO PRESERVE DIFFERENCES IN LUMINANCE BETWEEN DIFFERENT DATASETS
         
-    print(f'Saving {fname_gw}.nc')
-    data.to_netcdf(fname_gw + '.nc')
+    if conf.stream or conf.resume:
+        data.close()
+    else:
+        if conf.quantize is not None:
+            data = quantize_pixels(data, conf.quantize)
+        print(f'Saving {fname_gw}.nc')
+        data.to_netcdf(fname_gw + '.nc')
+
+    # Record exactly how this set was made so the loaders can find it by its parameters
+    key = registry.dataset_key(conf.min_num, conf.max_num, conf.noise_level, shapes, conf.same, conf.challenge,
+                               conf.grid, policy, conf.luminances, transform.rstrip('_'),
+                               'nogl' if conf.no_glimpse else conf.n_glimpses, conf.size, conf.truncate, conf.logscale)
+    registry.register_dataset(fname_gw, key, vars(conf), index_file=f'{dirname}/index.json')
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,99 @@
+"""Batched (log-)polar glimpse rendering.
+
+Reproduces skimage.transform.warp_polar(image, center, output_shape=...,
+scaling=..., mode='edge') (bilinear, order=1, default radius) for many images
+and glimpse centres at once. The inverse map of warp_polar only depends on the
+image shape and the centre, so the bilinear gather indices and weights for each
+centre are computed once and cached. Rendering a batch is then a single gather
+and weighted sum over the 4 neighbouring pixels.
+
+Agreement with warp_polar is limited only by floating point: the weights are
+computed in float64 like scipy's map_coordinates, so the max absolute
+difference is ~1e-6 for float32 images in [0, 1] (tested with TOLERANCE below).
+"""
+import numpy as np
+
+TOLERANCE = 1e-5
+
+
+class LogPolarRenderer():
+    """Caches warp_polar sampling plans for one image shape and scaling mode."""
+    def __init__(self, image_shape, output_shape=None, scaling='log'):
+        self.image_shape = tuple(int(s) for s in image_shape)
+        self.output_shape = self.image_shape if output_shape is None else tuple(int(s) for s in output_shape)
+        self.scaling = scaling
+        height, width = self.output_shape
+        # Same defaults as warp_polar
+        w, h = np.array(self.image_shape) / 2
+        radius = np.sqrt(w**2 + h**2)
+        if scaling == 'linear':
+            k_radius = width / radius
+        elif scaling == 'log':
+            k_radius = width / np.log(radius)
+        else:
+            raise ValueError("Scaling value must be in {'linear', 'log'}")
+        k_angle = height / (2 * np.pi)
+        # Output pixel (row, col) -> offset from the centre in the input image
+        rows, cols = np.indices(self.output_shape, dtype=np.float64).reshape(2, -1)
+        angle = rows / k_angle
+        if scaling == 'log':
+            rad = np.exp(cols / k_radius)
+        else:
+            rad = cols / k_radius
+        self.offset_rr = rad * np.sin(angle)
+        self.offset_cc = rad * np.cos(angle)
+        self.plans = {}
+
+    def plan(self, center):
+        """Flat gather indices (4, P) and bilinear weights (4, P) for one (row, col) centre."""
+        key = (float(center[0]), float(center[1]))
+        if key not in self.plans:
+            n_rows, n_cols = self.image_shape
+            rr = self.offset_rr + key[0]
+            cc = self.offset_cc + key[1]
+            r0 = np.floor(rr)
+            c0 = np.floor(cc)
+            wr = rr - r0
+            wc = cc - c0
+            # mode='edge' (scipy 'nearest'): clamp neighbours to the image
+            r0 = r0.astype(np.int64)
+            c0 = c0.astype(np.int64)
+            r1 = np.clip(r0 + 1, 0, n_rows - 1)
+            c1 = np.clip(c0 + 1, 0, n_cols - 1)
+            r0 = np.clip(r0, 0, n_rows - 1)
+            c0 = np.clip(c0, 0, n_cols - 1)
+            idx = np.stack([r0*n_cols + c0, r0*n_cols + c1, r1*n_cols + c0, r1*n_cols + c1])
+            weights = np.stack([(1 - wr)*(1 - wc), (1 - wr)*wc, wr*(1 - wc), wr*wc])
+            self.plans[key] = (idx.astype(np.int32), weights)
+        return self.plans[key]
+
+    def plan_table(self, centers):
+        """Plans for every distinct centre in centers (..., 2), stacked.
+
+        Returns ids with the shape of centers[..., 0] indexing the distinct
+        centres, and their gather indices (U, 4, P) and weights (U, 4, P).
+        """
+        centers = np.asarray(centers)
+        unique, ids = np.unique(centers.reshape(-1, 2), axis=0, return_inverse=True)
+        plans = [self.plan(c) for c in unique]
+        idx = np.stack([p[0] for p in plans])
+        weights = np.stack([p[1] for p in plans])
+        return ids.reshape(centers.shape[:-1]), idx, weights
+
+    def render(self, images, centers):
+        """Warp images (N, H, W) at centres (N, G, 2) given as (row, col).
+
+        Returns float32 glimpses of shape (N, G, out_H, out_W).
+        """
+        images = np.asarray(images)
+        centers = np.asarray(centers)
+        n_images, n_glimpses = centers.shape[:2]
+        plans = [self.plan(c) for c in centers.reshape(-1, 2)]
+        idx = np.stack([p[0] for p in plans]).reshape(n_images, -1)
+        weights = np.stack([p[1] for p in plans]).reshape(n_images, n_glimpses, 4, -1)
+        flat = images.reshape(n_images, -1).astype(np.float64)
+        values = np.take_along_axis(flat, idx, axis=1).reshape(weights.shape)
+        glimpses = (values * weights).sum(axis=2)
+        # warp clips to the input range, bilinear interpolation only leaks rounding error
+        glimpses = np.clip(glimpses, flat.min(axis=1)[:, None, None], flat.max(axis=1)[:, None, None])
+        return glimpses.reshape(n_images, n_glimpses, *self.output_shape).astype(np.float32)
@@ -0,0 +1,121 @@
+"""Registry of generated datasets.
+
+dataset_generator.py writes a manifest next to every dataset it saves
+(<name>.manifest.json: all generation settings, the lookup key and a content
+hash of the .nc file) and adds the dataset to image_sets/index.json, which maps
+the lookup key to the file. The loaders build the same key from their config
+and resolve it with a dictionary lookup instead of reconstructing file names.
+
+A dataset also serves any smaller size with otherwise the same key (see
+lookup_superset), as a prefix or balanced subset view made in loaders.py.
+
+The key only holds the parameters both sides know about. Shapes are kept as the
+string given on the command line (eg 'ESUZ') because the generator and config.py
+use different letter -> index maps.
+"""
+import os
+import json
+import fcntl
+import hashlib
+
+DATA_DIR = 'datasets/image_sets'
+INDEX_FILE = f'{DATA_DIR}/index.json'
+_index_cache = {}
+
+
+def dataset_key(min_num, max_num, noise_level, shapes, same, challenge, grid,
+                policy, luminances, transform, n_glimpses, size, truncate=False,
+                logscale=False):
+    """Canonical description of a dataset, used as the index key.
+
+    transform is 'logpolar', 'polar' or 'gw6' and n_glimpses is an int, 'nogl'
+    or None.
+    """
+    return {'min_num': int(min_num), 'max_num': int(max_num),
+            'noise_level': float(noise_level),
+            'shapes': ''.join([str(i) for i in shapes]), 'same': bool(same),
+            'challenge': challenge, 'grid': int(grid), 'policy': policy,
+            'luminances': [float(lum) for lum in luminances],
+            'transform': transform,
+            'n_glimpses': n_glimpses if n_glimpses in [None, 'nogl'] else int(n_glimpses),
+            'size': int(size), 'truncate': bool(truncate), 'logscale': bool(logscale)}
+
+
+def key_string(key):
+    return json.dumps(key, sort_keys=True)
+
+
+def content_hash(filename, block_size=2**23):
+    """sha1 of the file contents, read in 8 MB blocks."""
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def load_index(index_file=INDEX_FILE):
+    """Read the index, cached until the file changes."""
+    if not os.path.exists(index_file):
+        return {}
+    mtime = os.path.getmtime(index_file)
+    if index_file not in _index_cache or _index_cache[index_file][0] != mtime:
+        with open(index_file) as f:
+            _index_cache[index_file] = (mtime, json.load(f))
+    return _index_cache[index_file][1]
+
+
+def register_dataset(fname, key, settings, index_file=INDEX_FILE):
+    """Write fname.manifest.json and add fname (without extension) to the index.
+
+    Args:
+        fname (str): dataset path without extension, fname.nc must exist
+        key (dict): output of dataset_key
+        settings (dict): all generation settings, for the record
+    """
+    manifest = {'key': key, 'settings': settings,
+                'hash': content_hash(fname + '.nc'),
+                'file': os.path.basename(fname)}
+    with open(fname + '.manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    # Lock so generators finishing at the same time don't lose each other's
+    # entries, and re-read the index inside the lock
+    with open(index_file + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            index = {}
+            if os.path.exists(index_file):
+                with open(index_file) as f:
+                    index = json.load(f)
+            index[key_string(key)] = {'file': manifest['file'], 'hash': manifest['hash']}
+            # Write via a temporary file so concurrent readers never see half an index
+            tmp_file = f'{index_file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(index, f, indent=1)
+            os.replace(tmp_file, index_file)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    print(f'Registered {fname} in {index_file}')
+    return manifest
+
+
+def lookup_dataset(key, index_file=INDEX_FILE):
+    """Path (without extension) of the registered dataset for key, or None."""
+    entry = load_index(index_file).get(key_string(key))
+    if entry is None:
+        return None
+    return os.path.join(os.path.dirname(index_file), entry['file'])
+
+
+def lookup_superset(key, index_file=INDEX_FILE):
+    """Path and size of the smallest registered dataset that matches key in
+    everything but size and has at least key['size'] images, or (None, None)."""
+    wanted = {name: value for name, value in key.items() if name != 'size'}
+    best = (None, None)
+    for other_string, entry in load_index(index_file).items():
+        other = json.loads(other_string)
+        if other['size'] < key['size'] or {name: value for name, value in other.items() if name != 'size'} != wanted:
+            continue
+        if best[1] is None or other['size'] < best[1]:
+            best = (os.path.join(os.path.dirname(index_file), entry['file']), other['size'])
+    return best
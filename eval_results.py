@@ -0,0 +1,89 @@
+"""Per-image test results, stored epoch by epoch.
+
+Trainer.test writes the outcome for every test image (correct, predicted,
+true, losses, ...) into an EpochResults, which holds one preallocated array
+per column. After each epoch ResultsWriter saves the columns of all test
+sets as one .npz chunk (plus a 'test set' column) in
+results/logpolar/test_results_<base_name>/, so the trainer only holds the
+current epoch in memory. load_results reads the chunks back into the
+DataFrame main.py pickles, with the same columns as before.
+"""
+import os
+import glob
+import json
+import shutil
+import numpy as np
+import pandas as pd
+import torch
+
+
+class EpochResults():
+    """Columns of per-image results for one test set and epoch.
+
+    The columns stay on the device of the values added to them until column()
+    copies them to the host, so adding a batch doesn't wait for the device.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.columns = {}
+        self.n = 0
+
+    def add(self, n, columns):
+        """Append a batch of n images. columns maps column names to tensors,
+        arrays or scalars (broadcast to the whole batch)."""
+        for name, values in columns.items():
+            values = values.detach() if torch.is_tensor(values) else torch.as_tensor(np.asarray(values))
+            if name not in self.columns:
+                self.columns[name] = torch.empty(self.size, dtype=values.dtype, device=values.device)
+            self.columns[name][self.n:self.n + n] = values.reshape(-1) if values.ndim else values
+        self.n += n
+
+    def column(self, name):
+        return self.columns[name][:self.n].cpu().numpy()
+
+    def frame(self):
+        return pd.DataFrame({name: self.column(name) for name in self.columns})
+
+
+class ResultsWriter():
+    """Saves the EpochResults of all test sets as one chunk per epoch."""
+    def __init__(self, directory, test_loaders, config):
+        self.directory = directory
+        if os.path.exists(directory):
+            shutil.rmtree(directory)  # chunks of an earlier run with this base name
+        os.makedirs(directory)
+        # Columns that are constant within a test set are stored once
+        test_sets = [{'train shapes': str(config.train_shapes), 'test shapes': str(loader.shapes),
+                      'test lums': str(loader.lums), 'testset': loader.testset,
+                      'viewing': loader.viewing, 'repetition': config.rep} for loader in test_loaders]
+        with open(f'{directory}/test_sets.json', 'w') as f:
+            json.dump(test_sets, f, indent=1)
+
+    def write(self, ep, epoch_results):
+        names = epoch_results[0].columns.keys()
+        columns = {name: np.concatenate([res.column(name) for res in epoch_results]) for name in names}
+        columns['test set'] = np.repeat(np.arange(len(epoch_results), dtype=np.int8), [res.n for res in epoch_results])
+        with open(f'{self.directory}/epoch-{ep:04d}.npz.tmp', 'wb') as f:
+            np.savez(f, **columns)
+        os.replace(f'{self.directory}/epoch-{ep:04d}.npz.tmp', f'{self.directory}/epoch-{ep:04d}.npz')
+
+
+def load_results(directory, epochs=None):
+    """DataFrame of the per-image results in directory, of all epochs or of
+    the epochs in the list epochs."""
+    with open(f'{directory}/test_sets.json') as f:
+        test_sets = json.load(f)
+    frames = []
+    for fname in sorted(glob.glob(f'{directory}/epoch-*.npz')):
+        ep = int(os.path.basename(fname)[6:10])
+        if epochs is not None and ep not in epochs:
+            continue
+        with np.load(fname) as chunk:
+            frame = pd.DataFrame({name: chunk[name] for name in chunk.files})
+        frame['epoch'] = ep
+        frames.append(frame)
+    results = pd.concat(frames, ignore_index=True)
+    test_set = results.pop('test set').to_numpy()
+    for name in test_sets[0].keys():
+        results[name] = pd.Series([ts[name] for ts in test_sets]).to_numpy()[test_set]
+    return results
@@ -1,11 +1,20 @@
+import io
 import os
+import json
+import shutil
 import gc
+import hashlib
+from contextlib import redirect_stdout
 from itertools import product
+from argparse import Namespace
 import numpy as np
 import pandas as pd
 import xarray as xr
 import torch
-from torch.utils.data import TensorDataset, DataLoader
+from torch.utils.data import TensorDataset, DataLoader, IterableDataset, get_worker_info
+from datasets.registry import dataset_key, lookup_dataset, lookup_superset
+from datasets.logpolar import LogPolarRenderer
+from datasets.quantization import dequantize, packing
 
 
 def get_dataset(size, shapes_set, config, lums, solarize):
@@ -50,7 +59,18 @@ def get_dataset(size, shapes_set, config, lums, solarize):
     datadir = 'datasets/image_sets'
     fname_gw = f'{datadir}/num{min_num}-{max_num}_nl-{noise_level}_{shapes}{samee}{challenge}_grid{config.grid}_policy-{policy}_lum{lums}_{transform}{n_glimpses}{size}'
     
-    if os.path.exists(fname_gw + '.nc'):
+    # Look the dataset up in the registry index first, trying the transforms in
+    # the same order as the file name fallbacks below
+    transforms = [transform.rstrip('_'), 'logpolar'] + (['polar'] if config.whole_image else [])
+    n_gl = 'nogl' if 'glimpsing' in config.model_type else config.n_glimpses
+    keys = [dataset_key(min_num, max_num, noise_level, shapes, same, config.challenge, config.grid, policy, lums, tr, n_gl, size) for tr in transforms]
+    registered = [lookup_dataset(key) for key in keys]
+    registered = [fname for fname in registered if fname is not None]
+    if registered:
+        fname_gw = registered[0]
+        print(f'Loading registered dataset {fname_gw}')
+        data = xr.open_dataset(fname_gw + '.nc')
+    elif os.path.exists(fname_gw + '.nc'):
         print(f'Loading saved dataset {fname_gw}')
         # data = pd.read_pickle(fname_gw)
         data = xr.open_dataset(fname_gw + '.nc')
@@ -70,15 +90,59 @@ def get_dataset(size, shapes_set, config, lums, solarize):
                 print(f'Loading saved dataset {fname_gw}')
                 data = xr.open_dataset(fname_gw + '.nc')
         else:
-            print(f'{fname_gw}.nc does not exist. Exiting.')
-            raise FileNotFoundError
+            # Use a view of size images of a bigger registered dataset
+            supersets = [lookup_superset(key) for key in keys]
+            supersets = [(fname, n) for fname, n in supersets if fname is not None]
+            if not supersets:
+                print(f'{fname_gw}.nc does not exist and no registered dataset matches {keys[0]}. Exiting.')
+                raise FileNotFoundError
+            fname_gw, full_size = supersets[0]
+            print(f'Loading {config.subset_view} view of {size} of the {full_size} images in {fname_gw}')
+            data = dataset_view(xr.open_dataset(fname_gw + '.nc'), size, config.subset_view, config.challenge)
 
     data['filename'] = fname_gw
 
     return data
 
 
-def get_loader(dataset, config, batch_size=None, gaze=None):
+def dataset_view(data, size, mode='balanced', challenge=''):
+    """size images of the lazily opened dataset data, without reading them.
+
+    mode 'prefix' takes the first size images. Datasets are generated in
+    blocks of distractor counts, so a prefix is only balanced in numerosity.
+    mode 'balanced' takes the first images of every combination of
+    numerosity and number of distractors, in equal numbers (deterministic).
+    The positions in the file are kept in data.attrs['positions'].
+    """
+    if mode == 'prefix':
+        positions = np.arange(size)
+    elif mode == 'balanced':
+        if 'unique' in challenge:
+            labels = [data['num_unique'].values]
+        elif 'numerosity_target' in data:
+            labels = [data['numerosity_target'].values, data['numerosity_dist'].values]
+        else:
+            labels = [data['numerosity'].values]
+        strata, stratum = np.unique(np.stack(labels, axis=1), axis=0, return_inverse=True)
+        stratum = stratum.reshape(-1)
+        quota = [size // len(strata) + (s < size % len(strata)) for s in range(len(strata))]
+        positions = []
+        for s, n in enumerate(quota):
+            members = np.flatnonzero(stratum == s)[:n]
+            if len(members) < n:
+                raise ValueError(f'Only {len(members)} images with labels {strata[s]}, need {n} for a balanced view of {size}')
+            positions.append(members)
+        positions = np.sort(np.concatenate(positions))
+    else:
+        raise ValueError(f'Unknown subset view {mode}')
+    view = data.isel(image=positions)
+    view.attrs['positions'] = positions
+    view.attrs['view'] = f'{mode}{size}'
+    return view
+
+
+def get_tensors(dataset, config, gaze=None):
+    """Build the tuple of tensors for this model_type from an xarray dataset."""
     train_on = config.train_on
     cross_entropy_loss = config.cross_entropy
     outer = config.outer
@@ -315,28 +379,540 @@ def get_loader(dataset, config, batch_size=None, gaze=None):
     
     # Include the index as image ID to be able to match to image metadata
     if config.whole_image:    
-        dset = TensorDataset(index, input, count_num, dist_num, count_loc, pass_count)
+        tensors = (index, input, count_num, dist_num, count_loc, pass_count)
     elif model_type == 'logpolar_glimpsing':
-        dset = TensorDataset(index, image_input, xy, count_num, dist_num, count_loc, pass_count)
+        tensors = (index, image_input, xy, count_num, dist_num, count_loc, pass_count)
     elif 'unserial' in model_type:
-        dset = TensorDataset(index, input, count_num, dist_num, count_loc, pass_count)
+        tensors = (index, input, count_num, dist_num, count_loc, pass_count)
     # elif config.place_code:
-    #     dset = TensorDataset(index, xy, shape_input, count_num, dist_num, count_loc, shape_label, pass_count)
+    #     tensors = (index, xy, shape_input, count_num, dist_num, count_loc, shape_label, pass_count)
     elif model_type == 'map2num_decoder':
-        dset = TensorDataset(index, count_loc, count_num, dist_num, count_loc, pass_count)
+        tensors = (index, count_loc, count_num, dist_num, count_loc, pass_count)
     else:  
-        dset = TensorDataset(index, input, count_num, dist_num, count_loc, shape_label, pass_count)
-        # dset = TensorDataset(input, count_num, dist_num, count_loc, shape_label, pass_count)
-        # dset = TensorDataset(input, target, all_loc, shape_label, pass_count)
-        # dset = TensorDataset(input, target, true_loc, None, shape_label, pass_count)
+        tensors = (index, input, count_num, dist_num, count_loc, shape_label, pass_count)
+        # tensors = (input, count_num, dist_num, count_loc, shape_label, pass_count)
+        # tensors = (input, target, all_loc, shape_label, pass_count)
+        # tensors = (input, target, true_loc, None, shape_label, pass_count)
+    return tensors
+
+
+# Small per-image variables get_tensors may read for labels, whichever exist
+LABEL_VARIABLES = ['locations', 'locations_to_count', 'locations_count', 'locations_distract',
+                   'numerosity', 'numerosity_target', 'numerosity_dist', 'num_unique',
+                   'symbolic_shape']
+
+
+def required_variables(config, gaze=None):
+    """Names of the dataset variables get_tensors reads for this config,
+    following the same branches. Some are alternatives (eg the two humanlike
+    names), so the result can include variables a file doesn't have.
+    """
+    shape_format = config.shape_input
+    variables = ['filename'] + LABEL_VARIABLES
+    if 'human' in shape_format:
+        variables += ['symbolic_shape_humanlike']
+    if config.whole_image:
+        return variables + ['noised_image']
+    if config.train_on == 'both' or config.train_on == 'shape':
+        if shape_format == 'noise':
+            variables += ['noi_glimpse_pixels']
+        elif 'symbolic' in shape_format:
+            pass
+        elif 'logpolar' in shape_format:
+            if 'centre' in shape_format or 'center' in shape_format or gaze == 'fixed':
+                variables += ['centre_fixation']
+            elif 'human' in shape_format:
+                variables += ['logpolar_pixels_humanlike', 'humanlike_logpolar_pixels']
+            elif gaze == 'free':
+                variables += ['logpolar_pixels']
+            elif 'mixed' in shape_format:
+                variables += ['logpolar_pixels', 'centre_fixation']
+            else:
+                variables += ['logpolar_pixels']
+    if config.train_on == 'both' or config.train_on == 'xy':
+        if config.place_code and 'human' not in shape_format:
+            variables += ['glimpse_coords_image']
+        elif 'human' in shape_format:
+            variables += ['glimpse_coords_humanlike', 'humanlike_coords']
+        else:
+            variables += ['glimpse_coords_scaled']
+    return variables
+
+
+def select_variables(dataset, config, gaze=None):
+    """Subset of dataset with only the variables this config needs, read into
+    memory. Everything else (often most of the file) is never read."""
+    variables = [var for var in required_variables(config, gaze) if var in dataset.variables]
+    return dataset[variables].load()
+
+
+# config fields that change what get_tensors builds
+TENSOR_FIELDS = ['train_on', 'shape_input', 'model_type', 'target_type', 'n_glimpses',
+                 'challenge', 'min_num', 'sort', 'same', 'place_code', 'whole_image']
+
+
+def tensor_key(dataset, config, gaze=None):
+    """Identify the tensors get_tensors would build: the dataset file, a stamp
+    of its size and modification time, and a hash of the TENSOR_FIELDS."""
+    filename = str(dataset.filename.data)
+    stat = os.stat(filename + '.nc')
+    source = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    settings = {field: getattr(config, field) for field in TENSOR_FIELDS}
+    settings['gaze'] = gaze
+    settings['view'] = dataset.attrs.get('view')
+    key = hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:12]
+    return filename, source, settings, f'{os.path.basename(filename)}_{key}'
+
+
+def save_tensors(tensors, directory, meta):
+    """Write tensors as directory/<i>.npy plus meta.json, replacing directory
+    in one step so readers never see it half written.
+
+    Each process writes to its own temporary directory, so runs building the
+    same cache at the same time don't delete each other's files. If another
+    run puts its (identical) version in place first, ours is dropped.
+    """
+    tmp_dir = f'{directory}.{os.getpid()}.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)  # left by an interrupted run with this pid
+    os.makedirs(tmp_dir)
+    for i, tensor in enumerate(tensors):
+        np.save(f'{tmp_dir}/{i}.npy', tensor.cpu().numpy())
+    meta = dict(meta, on_device=[tensor.device.type != 'cpu' for tensor in tensors])
+    with open(f'{tmp_dir}/meta.json', 'w') as f:
+        json.dump(meta, f, indent=1)
+    old_dir = None
+    if os.path.exists(directory):
+        # Move the old version aside with one rename. A reader in between finds
+        # no meta and rebuilds, or loses the files it was opening (cache miss).
+        old_dir = f'{tmp_dir}.old'
+        try:
+            os.replace(directory, old_dir)
+        except FileNotFoundError:
+            old_dir = None
+    try:
+        os.replace(tmp_dir, directory)
+    except OSError:
+        shutil.rmtree(tmp_dir)  # another run got there first
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def read_meta(directory):
+    try:
+        with open(f'{directory}/meta.json') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def load_tensors(directory, meta, device):
+    """Memory-map the tensors written by save_tensors."""
+    tensors = []
+    for i, on_device in enumerate(meta['on_device']):
+        # copy-on-write so torch gets a writable array, pages stay shared until written
+        tensor = torch.from_numpy(np.load(f'{directory}/{i}.npy', mmap_mode='c'))
+        tensors.append(tensor.to(device) if on_device else tensor)
+    return tuple(tensors)
+
+
+def cached_tensors(dataset, config, gaze=None):
+    """get_tensors, but stored as .npy files the first time and memory-mapped
+    on later runs.
+
+    The cache directory is keyed by dataset file and the TENSOR_FIELDS of the
+    config. It is rebuilt when the .nc file's size or modification time
+    changes. Tensors with zero-stride views (which would be materialized) are
+    not cached.
+    """
+    filename, source, settings, name = tensor_key(dataset, config, gaze)
+    cache_dir = f'datasets/image_sets/tensor_cache/{name}'
+    meta = read_meta(cache_dir)
+    if meta is not None:
+        if meta['source'] == source:
+            print(f'Loading cached tensors {cache_dir}')
+            try:
+                return load_tensors(cache_dir, meta, config.device)
+            except FileNotFoundError:
+                # another run replaced the cache while we read it
+                print(f'{cache_dir} changed while loading. Rebuilding.')
+        else:
+            print(f'{filename}.nc changed since {cache_dir} was written. Rebuilding.')
+
+    tensors = get_tensors(select_variables(dataset, config, gaze), config, gaze)
+    if any(0 in tensor.stride() for tensor in tensors):
+        return tensors
+    print(f'Caching tensors to {cache_dir}')
+    save_tensors(tensors, cache_dir, {'source': source, 'settings': settings, 'file': filename})
+    return tensors
+
+
+class TensorBatchLoader():
+    """In-memory replacement for DataLoader(TensorDataset(*tensors), shuffle=True).
+
+    Draws one permutation per epoch and slices every tensor with a single
+    indexing op per batch instead of indexing and collating each example.
+    With device set, the tensors are moved there once up front. Keeps the
+    .dataset and .batch_size attributes and len() of a DataLoader.
+
+    dequantize maps tensor positions to the (scale, offset) of packed uint8
+    or int16 tensors (see datasets/quantization.py), which are converted to
+    float32 per batch on compute_device.
+    """
+    def __init__(self, tensors, batch_size, shuffle=True, device=None, dequantize=None, compute_device=None):
+        if device is not None:
+            tensors = [tensor.to(device) for tensor in tensors]
+        self.dataset = TensorDataset(*tensors)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.dequantize = {} if dequantize is None else dequantize
+        self.compute_device = compute_device
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        tensors = self.dataset.tensors
+        n = len(self.dataset)
+        order = torch.randperm(n) if self.shuffle else torch.arange(n)
+        devices = {tensor.device for tensor in tensors}
+        for start in range(0, n, self.batch_size):
+            idx = order[start:start + self.batch_size]
+            yield self.batch(idx, {device: idx.to(device) for device in devices})
+
+    def batch(self, idx, idx_on):
+        tensors = [tensor[idx_on[tensor.device]] for tensor in self.dataset.tensors]
+        for i, (scale, offset) in self.dequantize.items():
+            if self.compute_device is not None:
+                tensors[i] = tensors[i].to(self.compute_device)
+            tensors[i] = dequantize(tensors[i], scale, offset)
+        return tensors
+
+
+def pixel_loader_supported(config):
+    """Whether the glimpse pixels can be kept out of get_tensors' input (for
+    VirtualGlimpseLoader and QuantizedPixelLoader)."""
+    shape_format = config.shape_input
+    return not ('logpolar' not in shape_format or 'human' in shape_format or config.train_on not in ['both', 'shape']
+                or config.whole_image or 'unserial' in config.model_type or 'glimpsing' in config.model_type
+                or config.model_type == 'map2num_decoder')
+
+
+def fixed_gaze(config, n_images, gaze=None):
+    """Which images get the centre fixation glimpse at every time step, with
+    the same precedence as get_tensors."""
+    shape_format = config.shape_input
+    if 'centre' in shape_format or 'center' in shape_format or gaze == 'fixed':
+        return np.ones(n_images, dtype=bool)
+    elif gaze == 'free':
+        return np.zeros(n_images, dtype=bool)
+    elif 'mixed' in shape_format:
+        return np.arange(n_images) % 2 == 1
+    return np.zeros(n_images, dtype=bool)
+
+
+class PixelBatchLoader(TensorBatchLoader):
+    """TensorBatchLoader that adds the glimpse pixels of each batch to the
+    input in position 1: appended for train_on='both', replacing it for
+    train_on='shape'. tensors are what get_tensors builds with train_on='xy'.
+    Subclasses implement pixels(idx) -> (batch, n_glimpses, n_pixels).
+    """
+    def __init__(self, tensors, config, batch_size, shuffle=True, device=None):
+        super().__init__(tensors, batch_size, shuffle, device)
+        self.train_on = config.train_on
+
+    def batch(self, idx, idx_on):
+        tensors = super().batch(idx, idx_on)
+        pixels = self.pixels(idx)
+        if self.train_on == 'both':
+            tensors[1] = torch.cat((tensors[1].to(pixels.device), pixels), dim=-1)
+        else:
+            tensors[1] = pixels
+        return tensors
+
+
+class VirtualGlimpseLoader(PixelBatchLoader):
+    """Renders the log-polar glimpses of each batch from noised_image and
+    glimpse_coords_image instead of holding logpolar_pixels (or
+    centre_fixation) in memory. fixed marks the images that get the centre
+    fixation glimpse at every time step (see fixed_gaze), like centre_fixation
+    in the datasets.
+
+    The sampling plans of all distinct glimpse centres (at most one per
+    pixel) are built once, so a batch is one gather and weighted sum per
+    glimpse, in float64 like warp_polar.
+    """
+    def __init__(self, tensors, images, centres, fixed, config, batch_size, shuffle=True, device=None):
+        super().__init__(tensors, config, batch_size, shuffle, device)
+        # The datasets' logpolar_pixels and centre_fixation are both log scaled
+        renderer = LogPolarRenderer(images.shape[1:], scaling='log')
+        self.output_shape = renderer.output_shape
+        centres = np.array(centres)
+        centres[fixed] = [size//2 for size in images.shape[1:]]
+        ids, idx, weights = renderer.plan_table(centres)
+        # Rendered on device (eg the gpu with --batches_on_device) if given
+        self.render_device = torch.device('cpu') if device is None else device
+        self.images = torch.from_numpy(images).view(len(images), -1).to(self.render_device)
+        self.centre_ids = torch.from_numpy(ids).to(self.render_device)
+        self.plan_idx = torch.from_numpy(idx).long().to(self.render_device)
+        self.plan_weights = torch.from_numpy(weights).to(self.render_device)
+
+    def pixels(self, idx):
+        idx = idx.to(self.render_device)
+        flat = self.images[idx].double()
+        n_images, n_pixels = len(idx), self.plan_idx.shape[-1]
+        ids = self.centre_ids[idx]
+        out = torch.empty((n_images, ids.shape[1], n_pixels), dtype=torch.float64, device=self.render_device)
+        for g in range(ids.shape[1]):
+            values = torch.gather(flat, 1, self.plan_idx[ids[:, g]].view(n_images, -1))
+            out[:, g] = (values.view(n_images, 4, n_pixels) * self.plan_weights[ids[:, g]]).sum(dim=1)
+        # warp clips to the input range, bilinear interpolation only leaks rounding error
+        out = torch.maximum(torch.minimum(out, flat.max(dim=1).values[:, None, None]), flat.min(dim=1).values[:, None, None])
+        return out.float()
+
+
+class QuantizedPixelLoader(PixelBatchLoader):
+    """Keeps the glimpse pixels in the dataset's packed dtype (uint8 or
+    int16, see datasets/quantization.py) and converts only each batch to
+    float32, on compute_device."""
+    def __init__(self, tensors, pixels, scale, offset, config, batch_size, shuffle=True, device=None, compute_device=None):
+        super().__init__(tensors, config, batch_size, shuffle, device)
+        self.packed = pixels
+        self.scale = scale
+        self.offset = offset
+        self.compute_device = torch.device('cpu') if compute_device is None else compute_device
+
+    def pixels(self, idx):
+        packed = self.packed[idx.to(self.packed.device)].to(self.compute_device)
+        return dequantize(packed, self.scale, self.offset)
+
+
+def get_virtual_loader(dataset, config, batch_size, gaze=None, device=None):
+    """VirtualGlimpseLoader for dataset, only loading the labels, xy,
+    noised_image and glimpse_coords_image."""
+    if not pixel_loader_supported(config):
+        raise ValueError(f'Virtual glimpses only replace logpolar_pixels/centre_fixation input, not {config.shape_input} with train_on={config.train_on} and {config.model_type}')
+    xy_config = Namespace(**vars(config))
+    xy_config.train_on = 'xy'
+    tensors = get_tensors(select_variables(dataset, xy_config, gaze), xy_config, gaze)
+    images = dataset['noised_image'].values
+    centres = dataset['glimpse_coords_image'].values[..., ::-1]  # (x, y) -> (row, col)
+    fixed = fixed_gaze(config, len(images), gaze)
+    return VirtualGlimpseLoader(tensors, images, centres, fixed, config, batch_size, device=device)
+
+
+def get_quantized_loader(dataset, config, batch_size, gaze=None, device=None):
+    """QuantizedPixelLoader for a dataset written with --quantize. The glimpse
+    pixels are read undecoded, in their packed dtype."""
+    xy_config = Namespace(**vars(config))
+    xy_config.train_on = 'xy'
+    tensors = get_tensors(select_variables(dataset, xy_config, gaze), xy_config, gaze)
+    fixed = fixed_gaze(config, len(dataset.image), gaze)
+    with xr.open_dataset(f'{dataset.filename.data}.nc', mask_and_scale=False) as raw:
+        if 'positions' in dataset.attrs:
+            raw = raw.isel(image=dataset.attrs['positions'])
+        if fixed.all():
+            scale, offset = packing(raw['centre_fixation'])
+            centre = torch.from_numpy(raw['centre_fixation'].values)
+            nex, h, w = centre.shape
+            # As if repeating the same glimpse but without allocating that memory
+            pixels = centre.view(nex, 1, h*w).expand(nex, config.n_glimpses, h*w)
+        else:
+            scale, offset = packing(raw['logpolar_pixels'])
+            pixels = torch.from_numpy(raw['logpolar_pixels'].values)
+            if fixed.any():  # mixed
+                assert packing(raw['centre_fixation']) == (scale, offset)
+                centre = torch.from_numpy(raw['centre_fixation'].values[fixed])
+                pixels[fixed] = centre.unsqueeze(1)
+            nex, n_gl, h, w = pixels.shape
+            assert n_gl == config.n_glimpses
+            pixels = pixels.view(nex, n_gl, h*w)
+    print(f'Keeping {dataset.attrs["quantization"]} glimpse pixels in memory, {pixels.element_size()} bytes per pixel')
+    compute_device = config.device if device is None else device
+    return QuantizedPixelLoader(tensors, pixels, scale, offset, config, batch_size, device=device,
+                                compute_device=compute_device)
+
+
+class ChunkedNetCDFDataset(IterableDataset):
+    """Streams examples from a .nc dataset without loading it into memory.
+
+    The file is opened lazily in each DataLoader worker (one handle per
+    process) and read in contiguous blocks of chunk_images images, which are
+    converted with get_tensors. Blocks are visited in a new random order every
+    epoch, split across workers, and examples pass through a shuffle buffer of
+    buffer_size examples, so shuffling is at block + buffer granularity rather
+    than over the whole dataset.
+    """
+    def __init__(self, filename, config, gaze=None, chunk_images=256, buffer_size=2048, seed=0, positions=None):
+        self.filename = filename
+        self.positions = positions  # of a dataset_view, None for the whole file
+        self.config = Namespace(**vars(config))
+        self.config.device = torch.device('cpu')  # workers can't use cuda
+        self.gaze = gaze
+        # even, so the free/fixed alternation of shape_input=mixed is unchanged
+        self.chunk_images = chunk_images + chunk_images % 2
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.epoch = 0
+        if positions is None:
+            with xr.open_dataset(filename) as data:
+                self.size = len(data.image)
+        else:
+            self.size = len(positions)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        info = get_worker_info()
+        worker_id, n_workers = (0, 1) if info is None else (info.id, info.num_workers)
+        epoch = self.epoch
+        self.epoch += 1  # persists across epochs with persistent_workers
+        rng = torch.Generator().manual_seed(int(np.random.SeedSequence([self.seed, epoch, worker_id]).generate_state(1)[0]))
+        # Same chunk order in every worker, each takes every n_workers'th chunk
+        starts = np.arange(0, self.size, self.chunk_images)
+        order = torch.randperm(len(starts), generator=torch.Generator().manual_seed(self.seed + epoch))
+        my_starts = starts[order.numpy()][worker_id::n_workers]
+        buffer = []
+        with xr.open_dataset(self.filename) as data:
+            variables = [var for var in required_variables(self.config, self.gaze) if var in data.variables]
+            for start in my_starts:
+                if self.positions is None:
+                    chunk = data[variables].isel(image=slice(start, start + self.chunk_images))
+                else:
+                    chunk = data[variables].isel(image=self.positions[start:start + self.chunk_images])
+                with redirect_stdout(io.StringIO()):
+                    tensors = get_tensors(chunk, self.config, self.gaze)
+                buffer.extend(zip(*tensors))
+                while len(buffer) > self.buffer_size:
+                    yield buffer.pop(torch.randint(len(buffer), (1,), generator=rng).item())
+        for i in torch.randperm(len(buffer), generator=rng):
+            yield buffer[i]
+
+
+class DeviceDataLoader(DataLoader):
+    """DataLoader that moves each batch to device, since the dataset itself
+    can only build cpu tensors in the worker processes."""
+    def __init__(self, *args, device=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.device = device
+
+    def __iter__(self):
+        for batch in super().__iter__():
+            yield [tensor.to(self.device) for tensor in batch]
+
+
+def get_loader(dataset, config, batch_size=None, gaze=None, stream=False):
+    """Batch loader over the whole dataset held in memory, or with stream=True
+    read chunk by chunk from the .nc file in config.loader_workers workers.
+    With config.virtual_glimpses the glimpses are rendered per batch."""
     bs = config.batch_size if batch_size is None else batch_size
-    loader = DataLoader(dset, batch_size=bs, shuffle=True)
+    if stream:
+        dset = ChunkedNetCDFDataset(f'{dataset.filename.data}.nc', config, gaze, chunk_images=config.stream_chunk,
+                                    buffer_size=config.shuffle_buffer, seed=config.rep,
+                                    positions=dataset.attrs.get('positions'))
+        workers = config.loader_workers
+        loader = DeviceDataLoader(dset, batch_size=bs, num_workers=workers, persistent_workers=workers > 0,
+                                  device=config.device)
+    elif config.virtual_glimpses:
+        device = config.device if config.batches_on_device else None
+        loader = get_virtual_loader(dataset, config, bs, gaze, device)
+    elif dataset.attrs.get('quantization') is not None and pixel_loader_supported(config):
+        device = config.device if config.batches_on_device else None
+        loader = get_quantized_loader(dataset, config, bs, gaze, device)
+    else:
+        device = config.device if config.batches_on_device else None
+        if config.shm_data:
+            from shared_data import shared_tensors  # only needed here
+            tensors = shared_tensors(dataset, config, gaze)
+        elif config.tensor_cache:
+            tensors = cached_tensors(dataset, config, gaze)
+        else:
+            tensors = get_tensors(select_variables(dataset, config, gaze), config, gaze)
+        loader = TensorBatchLoader(tensors, bs, device=device)
     loader.filename = dataset.filename.data
+    loader.gaze = gaze
     dataset.close()
     
     return loader
 
 
+@torch.no_grad()
+def cache_ventral_features(model, loaders, config):
+    """Run every glimpse through the frozen ventral stream once.
+
+    The pixel part of each loader's input is replaced with the ventral
+    stream's output (shape_pred[:, :2] or the penultimate layer), so the
+    model only has to train the dorsal/rnn part. Features are stored in a
+    memory-mapped .npy file keyed by ventral checkpoint and dataset so later
+    runs with the same ventral model can reuse them.
+    """
+    if not hasattr(model, 'ventral_input') or model.finetune:
+        print('Ventral feature cache only applies to a frozen pretrained ventral stream. Skipping.')
+        return loaders
+    if config.procedural or config.stream_data or config.virtual_glimpses:
+        print('Ventral feature cache needs stored glimpses in memory, not used with --procedural, --stream_data or --virtual_glimpses. Skipping.')
+        return loaders
+    if config.train_on == 'xy' or config.learn_shape:
+        print('Ventral feature cache not used with train_on=xy or learn_shape. Skipping.')
+        return loaders
+    cache_dir = 'datasets/image_sets/ventral_cache'
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    with open(model.ventral_file, 'rb') as f:
+        ventral_hash = hashlib.sha1(f.read()).hexdigest()[:12]
+    rep = 'penult' if model.pass_penult else 'out'
+
+    def cache_one(loader):
+        filename = str(loader.filename)
+        dataset_mtime = int(os.path.getmtime(filename + '.nc'))
+        gaze = loader.gaze if loader.gaze is not None else 'train'
+        cache_file = f'{cache_dir}/{os.path.basename(filename)}_{config.shape_input}-{gaze}_ventral-{ventral_hash}-{rep}_{dataset_mtime}.npy'
+        tensors = list(loader.dataset.tensors)
+        input = tensors[1]
+        nex, n_glimpses = input.shape[:2]
+        if os.path.exists(cache_file):
+            print(f'Loading cached ventral features {cache_file}')
+        else:
+            print(f'Caching ventral features to {cache_file}')
+            flat_input = input.view(nex * n_glimpses, -1)
+            chunk = 8192  # glimpses at a time
+            features = None
+            # Filled under a name of this process and renamed when complete, so
+            # an interrupted or concurrent run never leaves a partial cache file
+            tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+            try:
+                for start in range(0, nex * n_glimpses, chunk):
+                    x, _ = model.ventral_input(flat_input[start:start + chunk].to(config.device))
+                    if features is None:
+                        features = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32,
+                                                             shape=(nex * n_glimpses, x.shape[1]))
+                    features[start:start + chunk] = x.cpu().numpy()
+                features.flush()
+            except BaseException:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+                raise
+            del features  # closes the memory map
+            os.replace(tmp_file, cache_file)
+        # Copy-on-write memory map (mode 'r' isn't writable, which torch warns
+        # about), so the features are read from the file, not copied to RAM
+        features = np.load(cache_file, mmap_mode='c')
+        tensors[1] = torch.from_numpy(features).view(nex, n_glimpses, -1)
+        new_loader = TensorBatchLoader(tensors, loader.batch_size)
+        for attr in ['filename', 'gaze', 'testset', 'viewing', 'shapes', 'lums']:
+            if hasattr(loader, attr):
+                setattr(new_loader, attr, getattr(loader, attr))
+        return new_loader
+
+    model.eval()
+    train_loader, test_loaders = loaders
+    train_loader = cache_one(train_loader) if train_loader is not None else None
+    test_loaders = [cache_one(loader) for loader in test_loaders]
+    model.use_cached_features = True
+    return [train_loader, test_loaders]
+
+
 
 # def get_loader(dataset, config, batch_size=None):
 #     """Prepare a torch DataLoader for the provided dataset.
@@ -560,7 +1136,9 @@ def get_loader(dataset, config, batch_size=None, gaze=None):
 #     loader = DataLoader(dset, batch_size=bs, shuffle=True)
 #     return loader
 
-def choose_loader(config):
+def choose_loader(config, test_only=False):
+    """Train loader and test loaders. With test_only the training set isn't
+    loaded and the train loader is None."""
     train_size = config.train_size
     test_size = config.test_size
     # try:
@@ -578,7 +1156,8 @@ def choose_loader(config):
         val_lums = lums1
         ood_lums = lums2
     # Get xarrays
-    trainset = get_dataset(train_size, config.shapestr, config, train_lums, solarize=config.solarize)
+    if not config.procedural and not test_only:
+        trainset = get_dataset(train_size, config.shapestr, config, train_lums, solarize=config.solarize)
     # testsets = [get_dataset(test_size, test_shapes, config, lums, solarize=config.solarize) for test_shapes, lums in product(config.testshapestr, config.lum_sets)]
     validation_set = get_dataset(test_size, config.shapestr, config, val_lums, solarize=config.solarize)
     
@@ -594,7 +1173,13 @@ def choose_loader(config):
     
     # train_loader = get_loader(trainset, config.train_on, config.cross_entropy, config.outer, config.shape_input, model_type, target_type)
     # test_loaders = [get_loader(testset, config.train_on, config.cross_entropy, config.outer, config.shape_input, model_type, target_type) for testset in testsets]
-    train_loader = get_loader(trainset, config)
+    if test_only:
+        train_loader = None
+    elif config.procedural:
+        from procedural import get_procedural_loader  # imports the generator, only needed here
+        train_loader = get_procedural_loader(config, config.shapestr, train_lums, train_size, validation_set)
+    else:
+        train_loader = get_loader(trainset, config, stream=config.stream_data)
     # Large batch size for test loader to test quicker
     # test_loaders = [get_loader(testset, config, batch_size=2500) for testset in testsets]
     val_free = get_loader(validation_set, config, batch_size=2500, gaze='free')
@@ -15,9 +15,10 @@ import torch
 
 from config import get_config, get_base_name
 from trainers import choose_trainer
-from loaders import choose_loader
+from loaders import choose_loader, cache_ventral_features
 from models import choose_model
 from utils import Timer
+from eval_results import load_results
 
 def set_device(config):
     """Specify the compute resource (CUDA or CPU) to train model with"""
@@ -56,6 +57,8 @@ def main(config):
     config.base_name = base_name
     loaders, test_xarray = choose_loader(config)
     model = choose_model(config, model_dir)
+    if config.cache_ventral:
+        loaders = cache_ventral_features(model, loaders, config)
     trainer = choose_trainer(model, loaders, test_xarray, config)
 
     # Train model and save trained model
@@ -65,9 +68,13 @@ def main(config):
     model_file_name = f'{model_dir}/{base_name}_ep-{config.n_epochs}.pt'
     torch.save(model, model_file_name)
     print(f'model file: {model_file_name}')
+    if config.procedural and config.procedural_indexed:
+        # the training set is only stored as the settings to regenerate it
+        train_loader, _ = loaders
+        train_loader.dataset.save_spec(f'{results_dir}/train_spec_{base_name}.json')
 
     # Organize and save results
-    train_losses, train_accs, test_losses, test_accs, confs, test_results = results
+    train_losses, train_accs, test_losses, test_accs, confs, test_results_dir = results
     (train_num_losses, train_map_losses, train_shape_loss) = train_losses
     (train_acc_count, train_acc_dist, train_acc_all) = train_accs
     (train_count_num_loss, train_dist_num_loss, train_all_num_loss) = train_num_losses
@@ -78,7 +85,9 @@ def main(config):
     (test_count_map_loss, test_dist_map_loss, test_full_map_loss) = test_map_losses
 
     # train_loss, train_acc, train_num_loss, train_shape_loss, train_full_map_loss, train_count_map_loss, test_loss, test_acc, test_num_loss, test_shape_loss, test_full_map_loss, test_count_map_loss, conf, test_results = results
+    test_results = load_results(test_results_dir)
     test_results.to_pickle(f'{results_dir}/test_results_{base_name}.pkl')
+    del test_results
     df_train = pd.DataFrame()
     df_test_list = [pd.DataFrame() for _ in range(4)]
     # df_train['loss'] = train_loss
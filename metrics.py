@@ -0,0 +1,35 @@
+"""Running sums of the training and test metrics, kept on the device.
+
+Calling .item() on a loss or a count makes the host wait for the device, so
+doing it every batch stops batches from overlapping. EpochMetrics adds the
+per-batch values as tensors on the device (in float64, so the sums are the
+same as adding up the .item()s) and copies them all to the host at once at
+the end of the epoch.
+"""
+import torch
+
+
+class EpochMetrics():
+    def __init__(self):
+        self.sums = {}
+
+    def add(self, name, value):
+        """Add value (a tensor of any shape or a number) to the sum called name."""
+        if torch.is_tensor(value):
+            value = value.detach().double()
+        if name in self.sums:
+            self.sums[name] = self.sums[name] + value
+        else:
+            self.sums[name] = value
+
+    def totals(self, *names):
+        """The sums called names, copied to the host with one sync: python
+        floats for scalars, float64 numpy arrays otherwise (None if nothing
+        was added)."""
+        totals = [self.sums.get(name) for name in names]
+        scalars = [i for i, value in enumerate(totals) if torch.is_tensor(value) and value.ndim == 0]
+        if scalars:
+            values = torch.stack([totals[i] for i in scalars]).tolist()
+            for i, value in zip(scalars, values):
+                totals[i] = value
+        return [value.cpu().numpy() if torch.is_tensor(value) else value for value in totals]
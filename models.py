@@ -342,6 +342,7 @@ class PretrainedVentral(nn.Module):
         self.output_size = output_size
         self.train_on = kwargs['train_on']
         ventral_file = kwargs['ventral']
+        self.ventral_file = ventral_file
         self.whole_im = kwargs['whole']
         self.gate = kwargs['gate'] if 'gate' in kwargs.keys() else False
         self.ce = True if 'loss-ce' in ventral_file else False
@@ -393,8 +394,33 @@ class PretrainedVentral(nn.Module):
         self.rnn = RNNClassifier2stream(shape_rep_len, hidden_size, map_size, output_size, **kwargs)
         self.initHidden = self.rnn.initHidden
         self.Softmax = nn.Softmax(dim=1)
+        # Set by loaders.cache_ventral_features once the inputs already hold the ventral features
+        self.use_cached_features = False
 
     def forward(self, x, hidden):
+        x, shape_pred = self.ventral_input(x)
+        num, pix, map_, hidden, premap, penult = self.rnn(x, hidden)
+        return num, shape_pred, map_, hidden, premap, penult
+
+    def forward_sequence(self, x_seq, hidden, readout_steps=None):
+        """Process all glimpses of x_seq (batch, n_glimpses, features) at once.
+
+        The ventral stream sees every glimpse of the batch in a single pass,
+        then the dorsal/rnn part runs RNNClassifier2stream.forward_sequence.
+        shape_pred is returned for every step.
+        """
+        batch_size, n_glimpses = x_seq.shape[:2]
+        x, shape_pred = self.ventral_input(x_seq.reshape(batch_size * n_glimpses, -1))
+        x = x.view(batch_size, n_glimpses, -1)
+        if shape_pred is not None:
+            shape_pred = shape_pred.view(batch_size, n_glimpses, -1)
+        num, pix, map_, hidden, premap, penult = self.rnn.forward_sequence(x, hidden, readout_steps)
+        return num, shape_pred, map_, hidden, premap, penult
+
+    def ventral_input(self, x):
+        """Replace the glimpse pixels with the ventral stream's shape representation."""
+        if self.use_cached_features:
+            return x, None
         if self.train_on == 'shape':
             pix = x
         elif self.train_on == 'xy':
@@ -447,9 +473,7 @@ class PretrainedVentral(nn.Module):
         elif self.train_on == 'xy':
             x = xy
             shape_pred = None
-        
-        num, pix, map_, hidden, premap, penult = self.rnn(x, hidden)
-        return num, shape_pred, map_, hidden, premap, penult
+        return x, shape_pred
 
 
 class RNNClassifier2stream2map(nn.Module):
@@ -785,16 +809,49 @@ class RNNClassifier2stream(nn.Module):
         self.LReLU = nn.LeakyReLU(0.1)
 
     def forward(self, x, hidden):
+        combined, pix = self.embed(x)
+        # if self.mult:
+            
+        #     x = self.LReLU(self.joint_embedding(xy, pix))
+        # else:
+        # x = self.LReLU(self.joint_BN(self.joint_embedding(combined)))
+        x = self.LReLU(self.joint_embedding(combined))
+        x, hidden = self.rnn(x, hidden)
+        # hidden = self.hidden_BN(hidden)
+        num, map_, x, penult = self.readout(x)
+        return num, pix, map_, hidden, x, penult
+        # return num, pix, map_, hidden, x, map_to_pass_on
+
+    def forward_sequence(self, x_seq, hidden, readout_steps=None):
+        """Process all glimpses of x_seq (batch, n_glimpses, features) at once.
+
+        Input embeddings are computed for the whole sequence in one go and
+        only the recurrent update is looped over. The readouts are computed
+        only at readout_steps (default last step), so num, map_, hidden, x and
+        penult have shape (batch, len(readout_steps), ...). pix is returned
+        for every step.
+        """
+        steps = [-1] if readout_steps is None else list(readout_steps)
+        combined, pix = self.embed(x_seq)
+        x = self.LReLU(self.joint_embedding(combined))
+        all_hidden, _ = self.rnn.forward_sequence(x, hidden)
+        hidden = all_hidden[:, steps]
+        x = self.rnn.h2o(hidden)
+        num, map_, x, penult = self.readout(x)
+        return num, pix, map_, hidden, x, penult
+
+    def embed(self, x):
+        """Input embeddings, works on a single glimpse or on a whole sequence."""
         if self.train_on == 'both':
-            xy = x[:, :self.xy_size]  # xy coords are first two input features typically unless place code
-            pix = x[:, self.xy_size:]
+            xy = x[..., :self.xy_size]  # xy coords are first two input features typically unless place code
+            pix = x[..., self.xy_size:]
             
             if not self.mult:
                 xy = self.LReLU(self.xy_embedding(xy))
                 pix = self.LReLU(self.pix_embedding(pix))
                 combined = torch.cat((xy, pix), dim=-1)
             else:
-                combined = torch.einsum('ij,ik->ijk', xy, pix).reshape(-1, xy.shape[1]*pix.shape[1])
+                combined = torch.einsum('...j,...k->...jk', xy, pix).flatten(start_dim=-2)
             # pix = self.LReLU(self.pix_embedding2(pix))
             # shape = self.shape_readout(pix)
             # shape_detached = shape.detach().clone()
@@ -810,15 +867,10 @@ class RNNClassifier2stream(nn.Module):
             pix = x
             pix = self.LReLU(self.pix_embedding(pix))
             combined = pix
-            
-        # if self.mult:
-            
-        #     x = self.LReLU(self.joint_embedding(xy, pix))
-        # else:
-        # x = self.LReLU(self.joint_BN(self.joint_embedding(combined)))
-        x = self.LReLU(self.joint_embedding(combined))
-        x, hidden = self.rnn(x, hidden)
-        # hidden = self.hidden_BN(hidden)
+        return combined, pix
+
+    def readout(self, x):
+        """Map and number readouts from the rnn output."""
         x = self.drop_layer(x)
 
         map_ = self.map_readout(x)
@@ -839,13 +891,12 @@ class RNNClassifier2stream(nn.Module):
         if self.par:
             # Two parallel layers, one to be a map, the other not
             notmap = self.notmap(x)
-            penult = torch.cat((map_to_pass_on, notmap), dim=1)
+            penult = torch.cat((map_to_pass_on, notmap), dim=-1)
         else:
             penult = map_to_pass_on
         num = self.num_readout(penult)
         # num = self.num_readout(penult)
-        return num, pix, map_, hidden, x, penult
-        # return num, pix, map_, hidden, x, map_to_pass_on
+        return num, map_, x, penult
 
 
 # class RNNClassifier(nn.Module):
@@ -952,12 +1003,33 @@ class NumAsMapsum2stream(nn.Module):
         self.LReLU = nn.LeakyReLU(0.1)
 
     def forward(self, x, hidden):
-        xy = x[:, :2]  # xy coords are first two input features
-        pix = x[:, 2:]
+        combined = self.embed(x)
+        x, hidden = self.rnn(combined, hidden)
+        num, map_ = self.readout(x)
+        return num, map_, hidden
+
+    def forward_sequence(self, x_seq, hidden, readout_steps=None):
+        """Process all glimpses of x_seq (batch, n_glimpses, features) at once.
+
+        Outputs are only computed at readout_steps (default last step) and
+        have shape (batch, len(readout_steps), ...).
+        """
+        steps = [-1] if readout_steps is None else list(readout_steps)
+        combined = self.embed(x_seq)
+        all_hidden, _ = self.rnn.forward_sequence(combined, hidden)
+        hidden = all_hidden[:, steps]
+        num, map_ = self.readout(self.rnn.h2o(hidden))
+        return num, map_, hidden
+
+    def embed(self, x):
+        xy = x[..., :2]  # xy coords are first two input features
+        pix = x[..., 2:]
         xy = self.LReLU(self.xy_embedding(xy))
         pix = self.LReLU(self.pix_embedding(pix))
         combined = torch.cat((xy, pix), dim=-1)
-        x, hidden = self.rnn(combined, hidden)
+        return combined
+
+    def readout(self, x):
         x = self.drop_layer(x)
         map_ = self.map_readout(x)
         sig = self.sigmoid(map_)
@@ -965,11 +1037,11 @@ class NumAsMapsum2stream(nn.Module):
             map_to_pass_on = sig.detach().clone()
         else:
             map_to_pass_on = sig
-        mapsum = torch.sum(map_to_pass_on, 1, keepdim=True)
+        mapsum = torch.sum(map_to_pass_on, -1, keepdim=True)
         num = self.num_readout(mapsum)
         # num = torch.round(torch.sum(x, 1))
         # num_onehot = nn.functional.one_hot(num, 9)
-        return num, map_, hidden
+        return num, map_
 
 class NumAsMapsum(nn.Module):
     def __init__(self, input_size, hidden_size, output_size, **kwargs):
@@ -1196,6 +1268,50 @@ class GatedMapper(nn.Module):
         self.LReLU = nn.LeakyReLU(0.1)
 
     def forward(self, xy, pix, hidden=None):
+        combined, shape = self.embed(xy, pix)
+        x = self.LReLU(self.joint_embedding(combined))
+        if hidden is None:
+            # x, hidden = self.rnn(x)
+            hidden = self.rnn(x)
+        else:
+            # x, hidden = self.rnn(x, hidden)
+            hidden = self.rnn(x, hidden)
+            
+        num, map_, x, penult = self.readout(hidden)
+        return num, shape, map_, hidden, x, penult
+
+    def forward_sequence(self, xy_seq, pix_seq, hidden=None, readout_steps=None):
+        """Process all glimpses (batch, n_glimpses, features) at once.
+
+        Embeddings and the input half of the RNNCell are computed for the
+        whole sequence in one go, only the hidden-to-hidden update is looped
+        over. Readouts are computed only at readout_steps (default last step)
+        and have shape (batch, len(readout_steps), ...). shape is returned for
+        every step.
+        """
+        steps = [-1] if readout_steps is None else list(readout_steps)
+        batch_size, n_glimpses = xy_seq.shape[:2]
+        # flatten glimpses into the batch dim, SparseLinear only takes 2d input
+        combined, shape = self.embed(xy_seq.flatten(0, 1), pix_seq.flatten(0, 1))
+        combined = combined.view(batch_size, n_glimpses, -1)
+        if shape is not None:
+            shape = shape.view(batch_size, n_glimpses, -1)
+        x = self.LReLU(self.joint_embedding(combined))
+        # Same as nn.RNNCell(x[:, t], hidden) at every step
+        x_proj = nn.functional.linear(x, self.rnn.weight_ih, self.rnn.bias_ih + self.rnn.bias_hh)
+        if hidden is None:
+            hidden = torch.zeros(x.shape[0], self.rnn.hidden_size, dtype=x.dtype, device=x.device)
+        all_hidden = []
+        for t in range(x.shape[1]):
+            hidden = torch.relu(torch.addmm(x_proj[:, t], hidden, self.rnn.weight_hh.t()))
+            all_hidden.append(hidden)
+        hidden = torch.stack(all_hidden, dim=1)[:, steps]
+        num, map_, x, penult = self.readout(hidden)
+        return num, shape, map_, hidden, x, penult
+
+    def embed(self, xy, pix):
+        """Input embeddings, works on a single glimpse or on a whole sequence."""
+        shape = None
         if self.train_on == 'both':
             # xy = x[:, :self.xy_size]  # xy coords are first two input features
             # pix = x[:, self.xy_size:]
@@ -1212,24 +1328,20 @@ class GatedMapper(nn.Module):
             # x = self.LReLU(self.joint_embedding(xy, pix))
             
             combined = torch.cat((xy, pix), dim=-1)
+        # The xy and shape branches used to read an undefined x (and never set
+        # shape), so train_on=xy or shape raised before they got here.
+        # They now embed the xy/pix argument; shape is None for xy and the
+        # shape readout of the embedded pixels for shape, as with 'both'.
         elif self.train_on == 'xy':
-            xy = x
             xy = self.LReLU(self.xy_embedding(xy))
             combined = xy
-            pix = torch.zeros_like(xy)
-            x = self.LReLU(self.joint_embedding(combined))
         elif self.train_on == 'shape':
-            pix = x
             pix = self.LReLU(self.pix_embedding(pix))
+            shape = self.shape_readout(pix)
             combined = pix
-        x = self.LReLU(self.joint_embedding(combined))
-        if hidden is None:
-            # x, hidden = self.rnn(x)
-            hidden = self.rnn(x)
-        else:
-            # x, hidden = self.rnn(x, hidden)
-            hidden = self.rnn(x, hidden)
-            
+        return combined, shape
+
+    def readout(self, hidden):
         x = self.drop_layer(hidden)
 
         map_ = self.map_readout(x)
@@ -1243,7 +1355,7 @@ class GatedMapper(nn.Module):
         if self.par:
             # Two parallel layers, one to be a map, the other not
             notmap = self.notmap(x)
-            penult = torch.cat((penult, notmap), dim=1)
+            penult = torch.cat((penult, notmap), dim=-1)
         # num = self.num_readout(map_to_pass_on)
         num = self.num_readout(penult)
-        return num, shape, map_, hidden, x, penult
\ No newline at end of file
+        return num, map_, x, penult
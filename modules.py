@@ -131,6 +131,27 @@ class RNN(nn.Module):
         output = self.h2o(hidden)
         return output, hidden
 
+    def forward_sequence(self, data_seq, last_hidden):
+        """Recurrent update over a whole (batch, seq_len, data_size) sequence.
+
+        Same as calling forward once per step, but the data half of i2h is
+        applied to all steps in one matmul so that only the hidden-to-hidden
+        product is left inside the loop. h2o is not applied, returns the
+        hidden state at every step (batch, seq_len, hidden_size) and the last.
+        """
+        data_size = data_seq.shape[-1]
+        w_data = self.i2h.weight[:, :data_size]
+        w_hidden = self.i2h.weight[:, data_size:]
+        data_proj = nn.functional.linear(data_seq, w_data, self.i2h.bias)
+        hidden = last_hidden
+        all_hidden = []
+        for t in range(data_seq.shape[1]):
+            hidden = torch.addmm(data_proj[:, t], hidden, w_hidden.t())
+            if self.act_fun is not None:
+                hidden = self.act_fun(hidden)
+            all_hidden.append(hidden)
+        return torch.stack(all_hidden, dim=1), hidden
+
     def init_params(self, gain):
         if self.act_fun == 'relu':
             nn.init.kaiming_uniform_(self.i2h.weight, a=math.sqrt(5), nonlinearity='relu')
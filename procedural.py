@@ -0,0 +1,184 @@
+"""Procedurally generated datasets.
+
+Instead of loading a pre-generated .nc file, images and glimpses are
+synthesized on the fly with datasets/dataset_generator.py (using the batched
+xy sampler, image synthesis and log-polar renderer) and converted with
+loaders.get_tensors, so batches have the same layout as get_loader's.
+
+ProceduralDataset generates new images every epoch. IndexedProceduralDataset
+is a fixed dataset in which image i is regenerated on demand from (seed, i),
+so only its spec (a small json file) needs to be stored.
+"""
+import io
+import json
+import random
+from argparse import Namespace
+from contextlib import redirect_stdout, contextmanager
+import numpy as np
+import torch
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+
+from datasets.dataset_generator import DatasetGenerator, process_args
+from loaders import get_tensors, DeviceDataLoader
+
+
+def generator_config(config, shapes, lums, block_size, seed, n_shapes, n_glimpses):
+    """DatasetGenerator settings matching the stored datasets for this config.
+    n_shapes and n_glimpses are the sizes of the stored test sets (see
+    stored_sizes), so symbolic_shape and the glimpse dim match theirs."""
+    gen_conf = Namespace(min_pass=config.min_pass, max_pass=config.max_pass,
+                         min_num=config.min_num, max_num=config.max_num,
+                         shapes=list(shapes), noise_level=config.noise_level,
+                         size=block_size, n_shapes=n_shapes, same=config.same,
+                         grid=config.grid, challenge=config.challenge,
+                         policy=config.policy, luminances=list(lums),
+                         solarize=config.solarize, no_glimpse=False, polar=True,
+                         scaling='log' if 'logpolar' in config.shape_input else 'linear',
+                         constant_contrast=config.constant_contrast,
+                         truncate=False, logscale=False,
+                         n_glimpses=n_glimpses, seed=seed, workers=0,
+                         shard_size=block_size, renderer='batched',
+                         synthesis='batched', xy_sampler='batched',
+                         buffer_dir=None)
+    return process_args(gen_conf)
+
+
+def stored_sizes(dataset):
+    """(n_shapes, n_glimpses) of a stored dataset. Also right when
+    config.n_glimpses is None, in which case the file name doesn't say."""
+    return dataset.sizes['character'], dataset.sizes['glimpse']
+
+
+@contextmanager
+def seeded_rng(seed):
+    """Seed random and np.random (which the generator draws from) and put
+    back their previous state afterwards, so generating in the main process
+    (loader_workers=0) doesn't reset the trainer's RNGs."""
+    py_state, np_state = random.getstate(), np.random.get_state()
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        yield
+    finally:
+        random.setstate(py_state)
+        np.random.set_state(np_state)
+
+
+class ProceduralDataset(IterableDataset):
+    """Generates fresh examples every epoch, split across DataLoader workers.
+
+    Each worker synthesizes blocks of block_size images (numerosity balanced
+    within a block) seeded from (seed, epoch, worker, block), and yields them
+    in shuffled order as the same tuples get_loader's TensorDataset holds.
+    """
+    def __init__(self, config, shapes, lums, size, n_shapes, n_glimpses, block_size=500, seed=0):
+        self.config = Namespace(**vars(config))
+        self.config.device = torch.device('cpu')  # workers can't use cuda
+        self.gen_conf = generator_config(config, shapes, lums, block_size, seed, n_shapes, n_glimpses)
+        self.size = size
+        self.block_size = block_size
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        info = get_worker_info()
+        worker_id, n_workers = (0, 1) if info is None else (info.id, info.num_workers)
+        per_worker = [self.size // n_workers + (w < self.size % n_workers) for w in range(n_workers)]
+        n_mine = per_worker[worker_id]
+        first_image = sum(per_worker[:worker_id])
+        epoch = self.epoch
+        self.epoch += 1  # persists across epochs with persistent_workers
+        with seeded_rng(self.seed):  # the constructor seeds the RNGs too
+            generator = DatasetGenerator(self.gen_conf)
+        n_done = 0
+        block = 0
+        while n_done < n_mine:
+            seed = int(np.random.SeedSequence([self.seed, epoch, worker_id, block]).generate_state(1)[0])
+            n = min(self.block_size, n_mine - n_done)
+            gen_conf = self.gen_conf
+            if n < self.block_size:
+                # The schedule of a shorter last block is made for its own
+                # length; a prefix of a block_size schedule has the distractor
+                # counts in runs, so it wouldn't be balanced.
+                gen_conf = Namespace(**vars(self.gen_conf))
+                gen_conf.size = n
+            with redirect_stdout(io.StringIO()), seeded_rng(seed):
+                toydata = generator.generate_dataset(gen_conf, 0, n)
+                data, _ = generator.add_logpolar_glimpses_xr(toydata, gen_conf)
+                data = data.assign_coords(image=np.arange(first_image + n_done, first_image + n_done + n))
+                tensors = get_tensors(data, self.config)
+            order = torch.randperm(n, generator=torch.Generator().manual_seed(seed))
+            for i in order:
+                yield tuple(tensor[i] for tensor in tensors)
+            n_done += n
+            block += 1
+
+
+class IndexedProceduralDataset(Dataset):
+    """Map-style dataset of size images where every random draw for image i
+    is seeded from (seed, i) (see DatasetGenerator.generate_keyed), so any
+    index can be re-synthesized exactly, independent of batch composition,
+    shuffling or the number of workers.
+    """
+    def __init__(self, config, shapes, lums, size, n_shapes, n_glimpses, seed=0):
+        self.config = Namespace(**vars(config))
+        self.config.device = torch.device('cpu')  # workers can't use cuda
+        self.shapes = list(shapes)
+        self.lums = list(lums)
+        self.size = size
+        self.seed = seed
+        self.gen_conf = generator_config(config, shapes, lums, size, seed, n_shapes, n_glimpses)
+        self.generator = None  # created in each worker process
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        return self.__getitems__([index])[0]
+
+    def __getitems__(self, indices):
+        # generate_keyed reseeds the RNGs for every image
+        with redirect_stdout(io.StringIO()), seeded_rng(self.seed):
+            if self.generator is None:
+                self.generator = DatasetGenerator(self.gen_conf)
+            indices = [int(i) for i in indices]
+            data, _ = self.generator.generate_keyed(indices, self.gen_conf, self.seed)
+            tensors = get_tensors(data, self.config)
+        return [tuple(tensor[k] for tensor in tensors) for k in range(len(indices))]
+
+    def save_spec(self, filename):
+        """Everything needed to regenerate this dataset."""
+        spec = {'shapes': self.shapes, 'luminances': self.lums, 'size': self.size,
+                'seed': self.seed, 'generator_settings': vars(self.gen_conf)}
+        with open(filename, 'w') as f:
+            json.dump(spec, f, indent=1)
+
+    @classmethod
+    def from_spec(cls, filename, config):
+        with open(filename) as f:
+            spec = json.load(f)
+        settings = spec['generator_settings']
+        return cls(config, spec['shapes'], spec['luminances'], spec['size'],
+                   settings['n_shapes'], settings['n_glimpses'], spec['seed'])
+
+
+def get_procedural_loader(config, shapes, lums, size, reference):
+    """Training loader that generates config.train_size new images per epoch,
+    or with --procedural_indexed the same size images every epoch. The images
+    have the sizes of the stored dataset reference (a test set)."""
+    workers = config.loader_workers
+    n_shapes, n_glimpses = stored_sizes(reference)
+    if config.procedural_indexed:
+        dset = IndexedProceduralDataset(config, shapes, lums, size, n_shapes, n_glimpses, seed=config.rep)
+        loader = DeviceDataLoader(dset, batch_size=config.batch_size, shuffle=True, num_workers=workers,
+                                  persistent_workers=workers > 0, device=config.device)
+    else:
+        dset = ProceduralDataset(config, shapes, lums, size, n_shapes, n_glimpses, seed=config.rep)
+        loader = DeviceDataLoader(dset, batch_size=config.batch_size, num_workers=workers,
+                                  persistent_workers=workers > 0, device=config.device)
+    loader.filename = 'procedural'
+    loader.gaze = None
+    return loader
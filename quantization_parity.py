@@ -0,0 +1,101 @@
+"""Check that storing the glimpse pixels quantized doesn't change what a trained
+model does.
+
+Runs a model saved by main.py on the float32 test sets and on quantized copies
+of them stored by dataset_generator.py --quantize (same settings and --seed,
+so the same images, generated into another directory). The quantized files
+are read the way training reads them, through get_loader, which keeps the
+pixels packed and dequantizes each batch (QuantizedPixelLoader). Reports the
+count accuracy on both, the difference, how often the two predictions agree
+and the rms / max difference of the input pixels.
+
+Example use (the main.py arguments the model was trained with, plus):
+$ python3 quantization_parity.py --model_file=models/logpolar/<base_name>_ep-100.pt --quantized_dir=<other dir>/datasets/image_sets --model_type=...
+"""
+import os
+import sys
+import numpy as np
+import xarray as xr
+import torch
+
+from config import get_config
+from loaders import choose_loader, get_loader
+from trainers import choose_trainer
+from main import set_device
+
+
+def pop_arg(name, default=None):
+    """Take --name=value out of sys.argv before config.py parses it."""
+    for arg in sys.argv[1:]:
+        if arg.startswith(f'--{name}='):
+            sys.argv.remove(arg)
+            return arg.split('=', 1)[1]
+    return default
+
+
+def quantized_loader(float_set, loader, quantized_dir, config):
+    """Loader over the stored quantized copy of the test set float_set, with
+    the same images in the same order as loader."""
+    fname = f'{quantized_dir}/{os.path.basename(str(float_set.filename.data))}'
+    data = xr.open_dataset(fname + '.nc')
+    if data.attrs.get('quantization') is None:
+        print(f'{fname}.nc is not quantized. Exiting.')
+        raise ValueError
+    if 'positions' in float_set.attrs:  # a view of a bigger dataset
+        data = data.isel(image=float_set.attrs['positions'])
+        data.attrs['positions'] = float_set.attrs['positions']
+    data['filename'] = fname
+    quantized = get_loader(data, config, batch_size=loader.batch_size, gaze=loader.gaze)
+    return quantized, data.attrs['quantization']
+
+
+@torch.no_grad()
+def parity(trainer, loaders, config):
+    """Count accuracy on the float32 and the quantized pixels, agreement of
+    the predictions and the rms and max pixel difference."""
+    model = trainer.model
+    device = config.device
+    n_correct = np.zeros(2)
+    n_agree = 0
+    sq_err = 0.
+    max_err = 0.
+    for float_batch, quant_batch in zip(*loaders):
+        (_, input, target, _, _, shape_label, _) = float_batch
+        quant_input, quant_target = quant_batch[1], quant_batch[2]
+        assert torch.equal(target.cpu(), quant_target.cpu()), 'the quantized set holds different images'
+        input, quant_input = input.to(device).float(), quant_input.to(device).float()
+        err = quant_input - input
+        sq_err += err.pow(2).sum().item()
+        max_err = max(max_err, err.abs().max().item())
+        target = target.to(device)
+        preds = []
+        for i, x in enumerate([input, quant_input]):
+            hidden = model.initHidden(x.shape[0]).to(device)
+            pred_num, _, _ = trainer.run_glimpses(x, hidden, shape_label.to(device))
+            pred = pred_num.argmax(dim=1)
+            n_correct[i] += pred.eq(target).sum().item()
+            preds.append(pred)
+        n_agree += preds[0].eq(preds[1]).sum().item()
+    n = len(loaders[0].dataset)
+    rms = np.sqrt(sq_err / (n * input[0].numel()))
+    return 100. * n_correct / n, 100. * n_agree / n, rms, max_err
+
+
+if __name__ == '__main__':
+    model_file = pop_arg('model_file')
+    quantized_dir = pop_arg('quantized_dir')
+    config = get_config()
+    config.device = set_device(config)
+    loaders, test_xarray = choose_loader(config)
+    model = torch.load(model_file, map_location=config.device)
+    model.eval()
+    trainer = choose_trainer(model, loaders, None, config)
+    _, test_loaders = loaders
+    rows = []
+    for loader, (name, float_set) in zip(test_loaders, test_xarray.items()):  # in the same order
+        quant_loader, dtype = quantized_loader(float_set, loader, quantized_dir, config)
+        loader.shuffle = quant_loader.shuffle = False
+        rows.append((name, loader, dtype) + parity(trainer, (loader, quant_loader), config))
+    print(f'{"testset":<12}{"viewing":<10}{"dtype":<7}{"float32 acc":>12}{"quant acc":>11}{"delta":>8}{"agree":>8}{"rms px err":>12}{"max px err":>12}')
+    for name, loader, dtype, (acc_float, acc_quant), agree, rms, max_err in rows:
+        print(f'{name:<12}{loader.viewing:<10}{dtype:<7}{acc_float:>12.2f}{acc_quant:>11.2f}{acc_quant - acc_float:>8.2f}{agree:>8.2f}{rms:>12.5f}{max_err:>12.5f}')
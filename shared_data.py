@@ -0,0 +1,134 @@
+"""Share loader tensors between training processes on one node.
+
+With --shm_data, the first main.py process that needs a dataset writes the
+tensors get_tensors builds for it as .npy files in /dev/shm, which is backed
+by RAM. Every process then memory-maps those files, so they all read the same
+physical pages instead of holding a private copy each.
+
+Each attached process leaves a pid file in <name>.refs/. When a process exits
+it removes its pid file, and the last one out deletes the tensors. Pid files of
+processes that died without cleaning up are ignored (and removed) whenever the
+refs are counted.
+
+    $ python3 shared_data.py          # list shared datasets and their users
+    $ python3 shared_data.py --clear  # remove the ones nobody is using
+"""
+import os
+import sys
+import atexit
+import fcntl
+import shutil
+from contextlib import contextmanager
+
+from loaders import get_tensors, select_variables, tensor_key, save_tensors, read_meta, load_tensors
+
+SHM_DIR = '/dev/shm/saccades'
+_attached = []
+
+
+@contextmanager
+def locked(name):
+    """Exclusive lock on one shared dataset, held across processes."""
+    os.makedirs(SHM_DIR, exist_ok=True)
+    with open(f'{SHM_DIR}/{name}.lock', 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # exists but belongs to someone else
+        return True
+    return True
+
+
+def live_refs(name):
+    """Pids of the processes still attached to name, dropping dead ones."""
+    ref_dir = f'{SHM_DIR}/{name}.refs'
+    if not os.path.exists(ref_dir):
+        return []
+    pids = []
+    for pid_file in os.listdir(ref_dir):
+        if pid_alive(int(pid_file)):
+            pids.append(int(pid_file))
+        else:
+            os.remove(f'{ref_dir}/{pid_file}')
+    return pids
+
+
+def attach(name):
+    ref_dir = f'{SHM_DIR}/{name}.refs'
+    os.makedirs(ref_dir, exist_ok=True)
+    open(f'{ref_dir}/{os.getpid()}', 'w').close()
+    if not _attached:
+        atexit.register(release_all)
+    _attached.append(name)
+
+
+def release(name):
+    """Detach this process from name and delete it if nobody else uses it."""
+    with locked(name):
+        pid_file = f'{SHM_DIR}/{name}.refs/{os.getpid()}'
+        if os.path.exists(pid_file):
+            os.remove(pid_file)
+        if not live_refs(name):
+            print(f'Removing {SHM_DIR}/{name} from shared memory')
+            shutil.rmtree(f'{SHM_DIR}/{name}', ignore_errors=True)
+            shutil.rmtree(f'{SHM_DIR}/{name}.refs', ignore_errors=True)
+
+
+def release_all():
+    while _attached:
+        release(_attached.pop())
+
+
+def shared_tensors(dataset, config, gaze=None):
+    """get_tensors, backed by one copy in /dev/shm per node.
+
+    Falls back to a private copy if the .nc file changed while other processes
+    still use the old tensors, or if the tensors have zero-stride views.
+    """
+    filename, source, settings, name = tensor_key(dataset, config, gaze)
+    directory = f'{SHM_DIR}/{name}'
+    with locked(name):
+        meta = read_meta(directory)
+        refs = live_refs(name)
+        if meta is not None and meta['source'] != source:
+            if refs:
+                print(f'{filename}.nc changed but {directory} is still used by {refs}. Loading a private copy.')
+                return get_tensors(select_variables(dataset, config, gaze), config, gaze)
+            print(f'{filename}.nc changed since {directory} was written. Rebuilding.')
+            meta = None
+        if meta is None:
+            tensors = get_tensors(select_variables(dataset, config, gaze), config, gaze)
+            if any(0 in tensor.stride() for tensor in tensors):
+                return tensors
+            print(f'Loading {filename} into shared memory {directory}')
+            save_tensors(tensors, directory, {'source': source, 'settings': settings, 'file': filename})
+            del tensors
+            meta = read_meta(directory)
+        else:
+            print(f'Attaching to shared {directory} ({len(refs)} other users)')
+        attach(name)
+        return load_tensors(directory, meta, config.device)
+
+
+if __name__ == '__main__':
+    if not os.path.exists(SHM_DIR):
+        quit()
+    names = [name for name in os.listdir(SHM_DIR) if os.path.isdir(f'{SHM_DIR}/{name}') and not name.endswith(('.refs', '.tmp', '.old'))]
+    for name in names:
+        with locked(name):
+            refs = live_refs(name)
+            if not refs and '--clear' in sys.argv:
+                print(f'Removing {name}')
+                shutil.rmtree(f'{SHM_DIR}/{name}', ignore_errors=True)
+                shutil.rmtree(f'{SHM_DIR}/{name}.refs', ignore_errors=True)
+            else:
+                print(f'{name}: used by {refs}')
@@ -13,6 +13,9 @@ from torch.optim import SGD, Adam, AdamW
 from torch.optim.lr_scheduler import StepLR, ReduceLROnPlateau
 
 from utils import Timer
+from eval_results import EpochResults, ResultsWriter
+from metrics import EpochMetrics
+from async_eval import AsyncEvaluator
 
 
 criterion = nn.CrossEntropyLoss()
@@ -95,16 +98,7 @@ class Trainer():
         config = self.config
         base_name = config.base_name
         device = config.device
-        avg_num_objects = config.max_num - ((config.max_num-config.min_num)/2)
-        n_locs = config.grid**2
-        weight_full = (n_locs - avg_num_objects)/ (avg_num_objects+2) # 9 for 9 locations
-        weight_count = (n_locs - avg_num_objects)/ avg_num_objects
-        pos_weight_count = torch.ones([n_locs], device=device) * weight_count
-        pos_weight_full = torch.ones([n_locs], device=device) * weight_full
-        self.criterion_bce_full = nn.BCEWithLogitsLoss(pos_weight=pos_weight_full)
-        self.criterion_bce_count = nn.BCEWithLogitsLoss(pos_weight=pos_weight_count)
-        self.criterion_bce_full_noreduce = nn.BCEWithLogitsLoss(pos_weight=pos_weight_full, reduction='none')
-        self.criterion_bce_count_noreduce = nn.BCEWithLogitsLoss(pos_weight=pos_weight_count, reduction='none')
+        self.init_map_criteria()
         n_epochs = config.n_epochs
 
         train_loss = np.zeros((n_epochs + 1,))
@@ -121,20 +115,18 @@ class Trainer():
         train_acc_all = np.zeros((n_epochs + 1,))
         train_acc_map = np.zeros((n_epochs + 1,))
         n_test_sets = len(config.test_shapes) * len(config.lum_sets)
-        test_loss = [np.zeros((n_epochs + 1,)) for _ in range(n_test_sets)]
+        test_arrays = self.new_test_arrays()
+        (test_loss, test_count_num_loss, test_count_map_loss, test_full_map_loss, test_sh_loss, test_acc_count, test_acc_map) = test_arrays
         # test_map_loss = [np.zeros((n_epochs,)) for _ in range(n_test_sets)]
-        test_full_map_loss = [np.zeros((n_epochs + 1,)) for _ in range(n_test_sets)]
-        test_count_map_loss = [np.zeros((n_epochs + 1,)) for _ in range(n_test_sets)]
         test_dist_map_loss = [np.zeros((n_epochs + 1,)) for _ in range(n_test_sets)]
-        test_count_num_loss = [np.zeros((n_epochs + 1,)) for _ in range(n_test_sets)]
         test_dist_num_loss = [np.zeros((n_epochs + 1,)) for _ in range(n_test_sets)]
         test_all_num_loss = [np.zeros((n_epochs + 1,)) for _ in range(n_test_sets)]
-        test_sh_loss = [np.zeros((n_epochs + 1,)) for _ in range(n_test_sets)]
-        test_acc_count = [np.zeros((n_epochs + 1,)) for _ in range(n_test_sets)]
-        test_acc_map = [np.zeros((n_epochs + 1,)) for _ in range(n_test_sets)]
         test_acc_dist = [np.zeros((n_epochs + 1,)) for _ in range(n_test_sets)]
         test_acc_all = [np.zeros((n_epochs + 1,)) for _ in range(n_test_sets)]
-        test_results = pd.DataFrame()
+        test_results_dir = f'{results_dir}/test_results_{base_name}'
+        results_writer = ResultsWriter(test_results_dir, self.test_loaders, config)
+        # With --async_eval a separate process tests the weights of each epoch
+        evaluator = AsyncEvaluator(self, results_writer) if config.async_eval else None
 
         ###### ASSESS PERFORMANCE BEFORE TRAINING #####
         ep_tr_loss, ep_tr_num_loss, tr_accuracy, ep_tr_sh_loss, ep_tr_map_loss, _, _, tr_map_acc = self.test(self.train_loader, 0)
@@ -144,30 +136,17 @@ class Trainer():
         train_count_map_loss[0], train_full_map_loss[0] = ep_tr_map_loss
         train_loss[0] = ep_tr_loss  # optimized loss
         train_sh_loss[0] = ep_tr_sh_loss
-        shape_lum = product(config.test_shapes, config.lum_sets)
-        # for ts, (test_loader, (test_shapes, lums)) in enumerate(zip(self.test_loaders, shape_lum)):
-        for ts, test_loader in enumerate(self.test_loaders):
-            epoch_te_loss, epoch_te_num_loss, te_accuracy, epoch_te_sh_loss, epoch_te_map_loss, epoch_df, _, te_map_acc = self.test(test_loader, 0)
-            epoch_df['train shapes'] = str(config.train_shapes)
-            # epoch_df['test shapes'] = str(test_shapes)
-            # epoch_df['test lums'] = str(lums)
-            epoch_df['test shapes'] = str(test_loader.shapes)
-            epoch_df['test lums'] = str(test_loader.lums)
-            epoch_df['testset'] = test_loader.testset
-            epoch_df['viewing'] = test_loader.viewing
-            epoch_df['repetition'] = config.rep
-            test_results = pd.concat((test_results, epoch_df), ignore_index=True)
-            test_count_num_loss[ts][0] = epoch_te_num_loss
-            test_acc_count[ts][0] = te_accuracy
-            test_acc_map[ts][0] = te_map_acc
-            test_count_map_loss[ts][0], test_full_map_loss[ts][0] = epoch_te_map_loss
-            test_loss[ts][0] = epoch_te_loss
-            test_sh_loss[ts][0] = epoch_te_sh_loss
+        # shape_lum = product(config.test_shapes, config.lum_sets)
+        if evaluator is None:
+            self.evaluate(0, test_arrays, results_writer)
+        else:
+            evaluator.submit(0, self.model)
         print(f'Before Training:')
         print(f'Train (Count/Dist/All) Num Loss={train_count_num_loss[0]:.4}/{train_dist_num_loss[0]:.4}/{train_all_num_loss[0]:.4} \t Accuracy={train_acc_count[0]:.3}%/{train_acc_dist[0]:.3}%/{train_acc_all[0]:.3}')
         print(f'Train (Count/Dist/All) Map Loss={train_count_map_loss[0]:.4}/{train_dist_map_loss[0]:.4}/{train_full_map_loss[0]:.4}')
-        print(f'Test (Count/Dist/All) Num Loss={test_count_num_loss[-1][0]:.4}/{test_dist_num_loss[-1][0]:.4}/{test_all_num_loss[-1][0]:.4} \t Accuracy={test_acc_count[-1][0]:.3}%/{test_acc_dist[-1][0]:.3}%/{test_acc_all[-1][0]:.3}')
-        print(f'Test (Count/Dist/All) Map Loss={test_count_map_loss[-1][0]:.4}/{test_dist_map_loss[-1][0]:.4}/{test_full_map_loss[-1][0]:.4}')
+        if evaluator is None:
+            print(f'Test (Count/Dist/All) Num Loss={test_count_num_loss[-1][0]:.4}/{test_dist_num_loss[-1][0]:.4}/{test_all_num_loss[-1][0]:.4} \t Accuracy={test_acc_count[-1][0]:.3}%/{test_acc_dist[-1][0]:.3}%/{test_acc_all[-1][0]:.3}')
+            print(f'Test (Count/Dist/All) Map Loss={test_count_map_loss[-1][0]:.4}/{test_dist_map_loss[-1][0]:.4}/{test_full_map_loss[-1][0]:.4}')
         
         savethisep = False
         threshold = 51
@@ -196,35 +175,22 @@ class Trainer():
             train_sh_loss[ep] = ep_tr_sh_loss
 
             ##### TEST ######
-            confs = [None for _ in self.test_loaders]
-            # shape_lum = product(config.test_shapes, config.lum_sets)
-            for ts, test_loader in enumerate(self.test_loaders):
-                epoch_te_loss, epoch_te_num_loss, te_accuracy, epoch_te_sh_loss, epoch_te_map_loss, epoch_df, conf, te_map_acc = self.test(test_loader, ep)
-                epoch_df['train shapes'] = str(config.train_shapes)
-                epoch_df['test shapes'] = str(test_loader.shapes)  # str(test_shapes)
-                epoch_df['test lums'] = str(test_loader.lums)  # str(lums)
-                epoch_df['testset'] = test_loader.testset
-                epoch_df['viewing'] = test_loader.viewing
-                epoch_df['repetition'] = config.rep
-                test_results = pd.concat((test_results, epoch_df), ignore_index=True) # detailed 
-                
-                test_count_num_loss[ts][ep] = epoch_te_num_loss
-                test_acc_count[ts][ep] = te_accuracy
-                test_acc_map[ts][ep] = te_map_acc
-                test_count_map_loss[ts][ep], test_full_map_loss[ts][ep] = epoch_te_map_loss
-                test_loss[ts][ep] = epoch_te_loss
-                test_sh_loss[ts][ep] = epoch_te_sh_loss
-                test_losses = (test_loss, test_count_num_loss, test_count_map_loss, test_sh_loss)
-                test_accs = (test_acc_count, test_acc_map)
-                confs[ts] = conf
-
-            if not ep % 10 or ep == n_epochs - 1 or ep==1:
+            plot_this_ep = not ep % 10 or ep == n_epochs - 1 or ep==1
+            if plot_this_ep:
                 train_num_losses = (train_count_num_loss, train_dist_num_loss, train_all_num_loss)
                 train_map_losses = (train_count_map_loss, train_dist_map_loss, train_full_map_loss)
                 train_accs = (train_acc_count, train_acc_dist, train_acc_all, train_acc_map)
                 train_losses = (train_num_losses, train_map_losses, train_sh_loss)
-                # self.plot_performance(test_results, train_losses, train_accs, confs, ep + 1, config)
-                self.plot_performance_quick(test_losses, test_accs, train_losses, train_accs, confs, ep + 1, config)
+            if evaluator is None:
+                confs = self.evaluate(ep, test_arrays, results_writer)  # detailed
+                test_losses = (test_loss, test_count_num_loss, test_count_map_loss, test_sh_loss)
+                test_accs = (test_acc_count, test_acc_map)
+                if plot_this_ep:
+                    # self.plot_performance(test_results, train_losses, train_accs, confs, ep + 1, config)
+                    self.plot_performance_quick(test_losses, test_accs, train_losses, train_accs, confs, ep + 1, config)
+            else:
+                # tested, printed and plotted by the evaluation process
+                evaluator.submit(ep, self.model, (train_losses, train_accs) if plot_this_ep else None)
             epoch_timer.stop_timer()
             if isinstance(test_loss, list):
                 print(f'Epoch {ep}. LR={self.optimizer.param_groups[0]["lr"]:.4}')
@@ -235,17 +201,19 @@ class Trainer():
                 # print(f'Test (Count/Dist/All) Map Loss={test_count_map_loss[-2][ep]:.4}/{test_dist_map_loss[-2][ep]:.4}/{test_full_map_loss[-2][ep]:.4}')
                 # -2 to get ood_free
                 print(f'Train Loss={train_loss[ep]:.4} \t Accuracy={train_acc_count[ep]:.3}% \t Map Accuracy={train_acc_map[ep]:.3}%' )
-                print(f'Test Val (Free/Fixed) Loss={test_count_num_loss[0][ep]:.4}/{test_count_num_loss[1][ep]:.4} \t Accuracy={test_acc_count[0][ep]:.3}%/{test_acc_count[1][ep]:.3}%')
-                print(f'Test OOD (Free/Fixed) Loss={test_count_num_loss[2][ep]:.4}/{test_count_num_loss[3][ep]:.4} \t Accuracy={test_acc_count[2][ep]:.3}%/{test_acc_count[3][ep]:.3}%')
-                print(f'Test Val (Free/Fixed) Map Loss={test_count_map_loss[0][ep]:.4}/{test_count_map_loss[1][ep]:.4} ')
-                print(f'Test OOD (Free/Fixed) Map Loss={test_count_map_loss[2][ep]:.4}/{test_count_map_loss[3][ep]:.4} ')
-                if config.learn_shape:
-                    print(f'Test Val (Free/Fixed) Shape Loss={test_sh_loss[0][ep]:.4}/{test_sh_loss[1][ep]:.4} ')
-                    print(f'Test OOD (Free/Fixed) Shape Loss={test_sh_loss[2][ep]:.4}/{test_sh_loss[3][ep]:.4} ')
+                if evaluator is None:
+                    self.print_test(ep, test_arrays)
 
             # else:
             #     print(f'Epoch {ep}. LR={optimizer.param_groups[0]["lr"]:.4} \t (Train/Test) Num Loss={train_num_loss[ep]:.4}/{test_num_loss[ep]:.4}/ \t Accuracy={train_acc[ep]:.3}%/{test_acc[ep]:.3}% \t Shape loss: {train_sh_loss[ep]:.5} \t Map loss: {train_map_loss[ep]:.5}')
         
+        if evaluator is not None:
+            print('Waiting for the evaluation process...')
+            worker_arrays, confs = evaluator.join()
+            for arrays, worker_array in zip(test_arrays, worker_arrays):
+                for ts in range(n_test_sets):
+                    arrays[ts][:] = worker_array[ts]
+
         # Save network activations
         if config.save_act:
             print('Saving activations...')
@@ -263,102 +231,182 @@ class Trainer():
         # res_tr  = [train_loss, train_acc, train_num_loss, train_sh_loss, train_full_map_loss, train_count_map_loss]
         # res_te = [test_loss, test_acc, test_num_loss, test_sh_loss, test_full_map_loss, test_count_map_loss, confs, test_results]
         res_tr = [train_losses, train_accs]
-        res_te = [test_losses, test_accs,  confs, test_results]
+        res_te = [test_losses, test_accs,  confs, test_results_dir]
         results_list = res_tr + res_te
         return self.model, results_list
 
+    def init_map_criteria(self):
+        """Map losses weighted for the expected number of objects."""
+        config = self.config
+        device = config.device
+        avg_num_objects = config.max_num - ((config.max_num-config.min_num)/2)
+        n_locs = config.grid**2
+        weight_full = (n_locs - avg_num_objects)/ (avg_num_objects+2) # 9 for 9 locations
+        weight_count = (n_locs - avg_num_objects)/ avg_num_objects
+        pos_weight_count = torch.ones([n_locs], device=device) * weight_count
+        pos_weight_full = torch.ones([n_locs], device=device) * weight_full
+        self.criterion_bce_full = nn.BCEWithLogitsLoss(pos_weight=pos_weight_full)
+        self.criterion_bce_count = nn.BCEWithLogitsLoss(pos_weight=pos_weight_count)
+        self.criterion_bce_full_noreduce = nn.BCEWithLogitsLoss(pos_weight=pos_weight_full, reduction='none')
+        self.criterion_bce_count_noreduce = nn.BCEWithLogitsLoss(pos_weight=pos_weight_count, reduction='none')
+
+    def new_test_arrays(self):
+        """Per-epoch test metrics, one array per test set: (loss, count num
+        loss, count map loss, full map loss, shape loss, count accuracy, map
+        accuracy)."""
+        n_epochs = self.config.n_epochs
+        n_test_sets = len(self.config.test_shapes) * len(self.config.lum_sets)
+        return tuple([np.zeros((n_epochs + 1,)) for _ in range(n_test_sets)] for _ in range(7))
+
+    def evaluate(self, ep, test_arrays, results_writer):
+        """Test on all test sets, fill in epoch ep of test_arrays and save the
+        per-image results. Returns the confusion matrices."""
+        (test_loss, test_count_num_loss, test_count_map_loss, test_full_map_loss, test_sh_loss, test_acc_count, test_acc_map) = test_arrays
+        confs = [None for _ in self.test_loaders]
+        epoch_results = [None for _ in self.test_loaders]
+        if self.config.single_pass_eval:
+            test_outputs = self.test_all(self.test_loaders, ep)
+        else:
+            test_outputs = (self.test(test_loader, ep) for test_loader in self.test_loaders)
+        for ts, test_output in enumerate(test_outputs):
+            epoch_te_loss, epoch_te_num_loss, te_accuracy, epoch_te_sh_loss, epoch_te_map_loss, epoch_results[ts], conf, te_map_acc = test_output
+            test_count_num_loss[ts][ep] = epoch_te_num_loss
+            test_acc_count[ts][ep] = te_accuracy
+            test_acc_map[ts][ep] = te_map_acc
+            test_count_map_loss[ts][ep], test_full_map_loss[ts][ep] = epoch_te_map_loss
+            test_loss[ts][ep] = epoch_te_loss
+            test_sh_loss[ts][ep] = epoch_te_sh_loss
+            confs[ts] = conf
+        results_writer.write(ep, epoch_results)
+        return confs
+
+    def print_test(self, ep, test_arrays):
+        (test_loss, test_count_num_loss, test_count_map_loss, test_full_map_loss, test_sh_loss, test_acc_count, test_acc_map) = test_arrays
+        print(f'Test Val (Free/Fixed) Loss={test_count_num_loss[0][ep]:.4}/{test_count_num_loss[1][ep]:.4} \t Accuracy={test_acc_count[0][ep]:.3}%/{test_acc_count[1][ep]:.3}%')
+        print(f'Test OOD (Free/Fixed) Loss={test_count_num_loss[2][ep]:.4}/{test_count_num_loss[3][ep]:.4} \t Accuracy={test_acc_count[2][ep]:.3}%/{test_acc_count[3][ep]:.3}%')
+        print(f'Test Val (Free/Fixed) Map Loss={test_count_map_loss[0][ep]:.4}/{test_count_map_loss[1][ep]:.4} ')
+        print(f'Test OOD (Free/Fixed) Map Loss={test_count_map_loss[2][ep]:.4}/{test_count_map_loss[3][ep]:.4} ')
+        if self.config.learn_shape:
+            print(f'Test Val (Free/Fixed) Shape Loss={test_sh_loss[0][ep]:.4}/{test_sh_loss[1][ep]:.4} ')
+            print(f'Test OOD (Free/Fixed) Shape Loss={test_sh_loss[2][ep]:.4}/{test_sh_loss[3][ep]:.4} ')
+
     @torch.no_grad()
     def test(self, loader, ep):
-        noreduce = True
         self.model.eval()
-        config = self.config
-        device = config.device
-        n_correct = 0
-        # correct_map  = 0
-        f1_sum = 0
-        epoch_loss = 0
-        num_epoch_loss = 0
-        count_map_epoch_loss = 0
-        # count_map_epoch_loss = 0
-        shape_epoch_loss = 0
+        device = self.config.device
+        metrics = EpochMetrics()
         # if 'unique' in config.challenge:
         #     max_num = 3
         #     min_num = 1
         #     confusion_matrix = np.zeros((max_num, max_num))
         # else:
         #     confusion_matrix = np.zeros((self.nclasses-config.min_num, self.nclasses-config.min_num))
-        confusion_matrix = None
-        test_results = pd.DataFrame()
+        test_results = EpochResults(len(loader.dataset))
         # for i, (input, target, locations, shape_label, pass_count) in enumerate(loader):
-        for i, (_, input, target, num_dist, all_loc, shape_label, pass_count) in enumerate(loader):
-            input = input.to(device)
+        for i, batch in enumerate(loader):
+            input = batch[1].to(device)
             input_dim = input.shape[0]
-            n_glimpses = input.shape[1]
-            batch_results = pd.DataFrame()
             hidden = self.model.initHidden(input_dim)
             hidden = hidden.to(device)
 
-            for t in range(n_glimpses):
-                pred_num, pred_shape, map, hidden, _, _ = self.model(input[:, t, :], hidden)
-                shape_loss = 0
-                if config.learn_shape:
-                    shape_loss_mse = criterion_mse(pred_shape, shape_label[:, t, :])#*10
-                    # shape_loss_ce = criterion(pred_shape, shape_label[:, t, :])
-                    shape_loss += shape_loss_mse #+ shape_loss_ce
+            pred_num, map, shape_loss = self.run_glimpses(input, hidden, batch[5])
+            self.score_batch(batch, pred_num, map, shape_loss, ep, metrics, test_results)
+        return self.summarize_test(loader, metrics, test_results)
 
-            losses, pred = self.get_losses(pred_num, target, map, all_loc, ep, noreduce)
-            loss, num_loss, map_loss, map_loss_to_add = losses
-            if config.learn_shape:
-                shape_loss /= n_glimpses
-                loss += shape_loss
-                shape_epoch_loss += shape_loss.item()
-            else:
-                shape_epoch_loss += -1
-            correct = pred.eq(target.view_as(pred))
-            batch_results['pass count'] = pass_count.detach().cpu().numpy()
-            batch_results['correct'] = correct.cpu().numpy()
-            batch_results['predicted'] = pred.detach().cpu().numpy()
-            batch_results['true'] = target.detach().cpu().numpy()
-            batch_results['loss'] = loss.detach().cpu().numpy()
-            try:
-                # Somehow before it was like just the first column was going
-                # into batch_results, so just map loss for the first out of
-                # nine location, instead of the average over all locations.
-                # batch_results['map loss'] = map_loss.mean(axis=1).detach().cpu().numpy()
-                # batch_results['map loss'] = map_loss.mean(axis=1).detach().cpu().numpy()
-                batch_results['full map loss'] = map_loss.detach().cpu().numpy()
-                # batch_results['count map loss'] = count_map_loss.detach().cpu().numpy()
-            except:
-                # batch_results['map loss'] = np.ones(loss.shape) * -1
-                batch_results['full map loss'] = np.ones(loss.shape) * -1
-                batch_results['count map loss'] = np.ones(loss.shape) * -1
-            batch_results['num loss'] = num_loss.detach().cpu().numpy()
-            batch_results['shape loss'] = shape_loss.detach().cpu().numpy() if self.config.learn_shape else -1
-            batch_results['epoch'] = ep
-            test_results = pd.concat((test_results, batch_results))
-
-            n_correct += pred.eq(target.view_as(pred)).sum().item()
-            
-            map_pred = torch.round(torch.sigmoid(map))
-            correct_map = map_pred.eq(all_loc)*1.0
-            positive = map_pred.eq(1.)*1.0
-            true_positive = torch.logical_and(correct_map, positive) * 1.0
-            precision = true_positive.sum(dim=0) / positive.sum(dim=0)
-            true = all_loc.sum(dim=0)
-            recall = true_positive.sum(dim=0)/true
-            f1 = 2*((precision * recall)/(precision + recall)) 
-            f1_sum += f1.nanmean().item()
-            
-            epoch_loss += loss.mean().item()
-            num_epoch_loss += num_loss.mean().item()
-            # if not isinstance(map_loss_to_add, int):
-            #     map_loss_to_add = map_loss_to_add.item()
-            count_map_epoch_loss += map_loss_to_add
-            # class-specific analysis and confusion matrix
-            # c = (pred.squeeze() == target)
-            if self.config.use_loss != 'map':
-                confusion_matrix = self.update_confusion(target, pred, num_dist, confusion_matrix)
+    @torch.no_grad()
+    def test_all(self, loaders, ep):
+        """self.test on each of loaders, running the model on all of them together.
+
+        The batches of each loader are drawn as usual, so every test set is
+        split into the same batches as by separate self.test calls. Batches
+        are concatenated across test sets into chunks of up to
+        config.eval_batch_size images that go through the model in one pass,
+        and the outputs are split back into the batches to be scored.
+        """
+        if type(self).test is not Trainer.test:
+            # Other trainers have their own batch layout
+            return [self.test(loader, ep) for loader in loaders]
+        self.model.eval()
+        device = self.config.device
+        metrics = [EpochMetrics() for _ in loaders]
+        test_results = [EpochResults(len(loader.dataset)) for loader in loaders]
+        batches = [(ts, batch) for ts, loader in enumerate(loaders) for batch in loader]
+        chunk = []
+        for k, (ts, batch) in enumerate(batches):
+            chunk.append((ts, batch))
+            sizes = [len(b[1]) for _, b in chunk]
+            if k + 1 < len(batches) and sum(sizes) + len(batches[k + 1][1][1]) <= self.config.eval_batch_size:
+                continue
+            input = torch.cat([b[1].to(device) for _, b in chunk])
+            shape_label = torch.cat([b[5] for _, b in chunk])
+            hidden = self.model.initHidden(input.shape[0])
+            hidden = hidden.to(device)
+            pred_num, map, shape_loss = self.run_glimpses(input, hidden, shape_label, sizes)
+            for (ts_b, b), pred_num_b, map_b, shape_loss_b in zip(chunk, pred_num.split(sizes), map.split(sizes), shape_loss):
+                self.score_batch(b, pred_num_b, map_b, shape_loss_b, ep, metrics[ts_b], test_results[ts_b])
+            chunk = []
+        return [self.summarize_test(*args) for args in zip(loaders, metrics, test_results)]
+
+    def score_batch(self, batch, pred_num, map, shape_loss, ep, metrics, test_results):
+        """Add the losses and outcomes of one test batch to metrics and test_results."""
+        noreduce = True
+        config = self.config
+        _, input, target, num_dist, all_loc, shape_label, pass_count = batch
+        n_glimpses = input.shape[1]
+        losses, pred = self.get_losses(pred_num, target, map, all_loc, ep, noreduce)
+        loss, num_loss, map_loss, map_loss_to_add = losses
+        if config.learn_shape:
+            shape_loss /= n_glimpses
+            loss += shape_loss
+            metrics.add('shape_epoch_loss', shape_loss)
+        else:
+            metrics.add('shape_epoch_loss', -1)
+        correct = pred.eq(target.view_as(pred))
+        batch_results = {'pass count': pass_count, 'correct': correct, 'predicted': pred,
+                         'true': target, 'loss': loss}
+        try:
+            # Somehow before it was like just the first column was going
+            # into batch_results, so just map loss for the first out of
+            # nine location, instead of the average over all locations.
+            # batch_results['map loss'] = map_loss.mean(axis=1).detach().cpu().numpy()
+            # batch_results['map loss'] = map_loss.mean(axis=1).detach().cpu().numpy()
+            batch_results['full map loss'] = map_loss.detach()
+            # batch_results['count map loss'] = count_map_loss.detach().cpu().numpy()
+        except:
+            # batch_results['map loss'] = np.ones(loss.shape) * -1
+            batch_results['full map loss'] = -1.
+            batch_results['count map loss'] = -1.
+        batch_results['num loss'] = num_loss
+        batch_results['shape loss'] = shape_loss if self.config.learn_shape else -1
+        test_results.add(len(target), batch_results)
+
+        metrics.add('n_correct', correct.sum())
+
+        map_pred = torch.round(torch.sigmoid(map))
+        correct_map = map_pred.eq(all_loc)*1.0
+        positive = map_pred.eq(1.)*1.0
+        true_positive = torch.logical_and(correct_map, positive) * 1.0
+        precision = true_positive.sum(dim=0) / positive.sum(dim=0)
+        true = all_loc.sum(dim=0)
+        recall = true_positive.sum(dim=0)/true
+        f1 = 2*((precision * recall)/(precision + recall)) 
+        metrics.add('f1_sum', f1.nanmean())
+
+        metrics.add('epoch_loss', loss.mean())
+        metrics.add('num_epoch_loss', num_loss.mean())
+        # if not isinstance(map_loss_to_add, int):
+        #     map_loss_to_add = map_loss_to_add.item()
+        metrics.add('count_map_epoch_loss', map_loss_to_add)
+        # class-specific analysis and confusion matrix
+        # c = (pred.squeeze() == target)
+        if self.config.use_loss != 'map':
+            metrics.add('confusion_matrix', self.update_confusion(target, pred, num_dist))
 
+    def summarize_test(self, loader, metrics, test_results):
+        """The values self.test returns, from the metrics of all batches."""
+        config = self.config
+        n_correct, f1_sum, epoch_loss, num_epoch_loss, count_map_epoch_loss, shape_epoch_loss, confusion_matrix = metrics.totals(
+            'n_correct', 'f1_sum', 'epoch_loss', 'num_epoch_loss', 'count_map_epoch_loss', 'shape_epoch_loss', 'confusion_matrix')
         # These two lines should be the same
         # map_epoch_loss / len(loader.dataset)
         # test_results['map loss'].mean()
@@ -384,13 +432,7 @@ class Trainer():
         self.model.train()
         noreduce = False
         config = self.config
-        correct = 0
-        f1_sum = 0
-        epoch_loss = 0
-        num_epoch_loss = 0
-        # map_epoch_loss = 0
-        count_map_epoch_loss = 0
-        shape_epoch_loss = 0
+        metrics = EpochMetrics()
 
         for i, (_, input, target, num_dist, locations, shape_label, _) in enumerate(loader):
             # assert all(locations.sum(dim=1) == target)
@@ -411,15 +453,7 @@ class Trainer():
             hidden = self.model.initHidden(input_dim)
             hidden = hidden.to(config.device)
 
-            for t in range(n_glimpses):
-                pred_num, pred_shape, map, hidden, _, _ = self.model(input[:, t, :], hidden)
-                shape_loss=0
-                if config.learn_shape:
-                    shape_loss_mse = criterion_mse(pred_shape, shape_label[:, t, :])
-                    # shape_loss_ce = criterion(pred_shape, shape_label[:, t, :])
-                    shape_loss += shape_loss_mse #+ shape_loss_ce
-                    
-                    # shape_loss.backward(retain_graph=True)
+            pred_num, map, shape_loss = self.run_glimpses(input, hidden, shape_label)
 
             losses, pred = self.get_losses(pred_num, target, map, locations, ep, noreduce)
             loss, num_loss, map_loss, map_loss_to_add = losses
@@ -427,9 +461,9 @@ class Trainer():
             if config.learn_shape:
                 shape_loss /= n_glimpses
                 loss += shape_loss
-                shape_epoch_loss += shape_loss.item()
+                metrics.add('shape_epoch_loss', shape_loss)
             else:
-                shape_epoch_loss += -1
+                metrics.add('shape_epoch_loss', -1)
 
             loss.backward()
             # Debugging code to monitor gradient norm at each layer
@@ -442,7 +476,7 @@ class Trainer():
             nn.utils.clip_grad_norm_(self.model.parameters(), 2)
             self.optimizer.step()
 
-            correct += pred.eq(target.view_as(pred)).sum().item()
+            metrics.add('correct', pred.eq(target.view_as(pred)).sum())
             map_pred = torch.round(torch.sigmoid(map))
             correct_map = map_pred.eq(locations)*1.0
             positive = map_pred.eq(1.)*1.0
@@ -451,15 +485,17 @@ class Trainer():
             true = locations.sum(dim=0)
             recall = true_positive.sum(dim=0)/true
             f1 = 2*((precision * recall)/(precision + recall)) 
-            f1_sum += f1.nanmean().item()
+            metrics.add('f1_sum', f1.nanmean())
             
-            epoch_loss += loss.item()
-            num_epoch_loss += num_loss.item()
+            metrics.add('epoch_loss', loss)
+            metrics.add('num_epoch_loss', num_loss)
             # if not isinstance(map_loss_to_add, int):
                 # map_loss_to_add = map_loss_to_add.item()
-            count_map_epoch_loss += map_loss_to_add
+            metrics.add('count_map_epoch_loss', map_loss_to_add)
             # count_map_epoch_loss += count_map_loss_to_add 
             
+        correct, f1_sum, epoch_loss, num_epoch_loss, count_map_epoch_loss, shape_epoch_loss = metrics.totals(
+            'correct', 'f1_sum', 'epoch_loss', 'num_epoch_loss', 'count_map_epoch_loss', 'shape_epoch_loss')
         accuracy = 100. * (correct/len(loader.dataset))
         # map_acc = 100 * (correct_map/(len(loader)))
         map_f1 = 100. * (f1_sum/len(loader))
@@ -592,20 +628,18 @@ class Trainer():
         if self.config.use_loss != 'map':
             self.plot_confusion(confs)
 
-    def update_confusion(self, target, pred, num_dist, confusion_matrix):
-        if confusion_matrix is None:
-            if 'unique' in self.config.challenge:
-                max_num = 3
-                min_num = 1
-                confusion_matrix = np.zeros((max_num, max_num))
-            else:
-                # confusion_matrix = np.zeros((self.nclasses-self.config.min_num, self.nclasses-self.config.min_num))
-                confusion_matrix = np.zeros((self.nclasses, self.nclasses))
-            
-        for label, prediction in zip(target, pred):
-            # confusion_matrix[label - self.to_subtract, prediction - self.to_subtract] += 1
-            confusion_matrix[label, prediction] += 1
-        return confusion_matrix
+    def update_confusion(self, target, pred, num_dist):
+        """Counts of (true, predicted) class in one batch (float64, like the
+        np.zeros matrices they replace), added up on the device with
+        index_add_ (bincount would read the max back from it)."""
+        if 'unique' in self.config.challenge:
+            n = 3  # max_num
+        else:
+            # n = self.nclasses-self.config.min_num
+            n = self.nclasses
+        flat = target.view(-1) * n + pred.view(-1)
+        counts = torch.zeros(n * n, dtype=torch.float64, device=flat.device)
+        return counts.index_add_(0, flat, torch.ones_like(flat, dtype=torch.float64)).view(n, n)
 
     def plot_confusion(self, confs):
         fig, axs = plt.subplots(2, 2, figsize=(19, 16))
@@ -800,11 +834,16 @@ class Trainer():
                     hidden = model.initHidden(batch_size).to(device)
                     xy = input_[:, :, :2].cpu().detach().numpy()
                     glimpse_coords[start: start + batch_size] = xy
-                    for t in range(n_glimpses):
-                        pred_num, _, _, hidden, premap, penult = model(input_[:, t, :], hidden)
-                        hidden_act[start: start + batch_size, t] = hidden.cpu().detach().numpy()
-                        # premap_act[start: start + batch_size, t] = premap.cpu().detach().numpy()
-                        # penult_act[start: start + batch_size, t] = penult.cpu().detach().numpy()
+                    if hasattr(model, 'forward_sequence'):
+                        pred_num, _, _, hidden, premap, penult = model.forward_sequence(input_, hidden, range(n_glimpses))
+                        pred_num = pred_num[:, -1]
+                        hidden_act[start: start + batch_size] = hidden.cpu().detach().numpy()
+                    else:
+                        for t in range(n_glimpses):
+                            pred_num, _, _, hidden, premap, penult = model(input_[:, t, :], hidden)
+                            hidden_act[start: start + batch_size, t] = hidden.cpu().detach().numpy()
+                            # premap_act[start: start + batch_size, t] = premap.cpu().detach().numpy()
+                            # penult_act[start: start + batch_size, t] = penult.cpu().detach().numpy()
 
                 pred = pred_num.argmax(dim=1, keepdim=True)
                 predicted_num[start: start + batch_size] = softmax(pred_num).cpu().detach().numpy()
@@ -857,14 +896,47 @@ class Trainer():
             # MATLAB
             savemat(savename + '.mat', to_save)
 
+    def run_glimpses(self, input, hidden, shape_label, sizes=None):
+        """Pass the glimpse sequence through the model.
+
+        Uses the model's forward_sequence when it has one, otherwise steps
+        through the glimpses one at a time. Returns the number and map
+        predictions at the last glimpse and the shape loss (also computed at
+        the last glimpse only). With sizes, input holds batches of these sizes
+        one after the other and the shape loss is a list with one per batch.
+        """
+        if hasattr(self.model, 'forward_sequence'):
+            pred_num, pred_shape, map, _, _, _ = self.model.forward_sequence(input, hidden)
+            pred_num = pred_num[:, -1]
+            map = map[:, -1]
+            if self.config.learn_shape:  # shape_pred is None with train_on=xy or cached ventral features
+                pred_shape = pred_shape[:, -1]
+        else:
+            for t in range(input.shape[1]):
+                pred_num, pred_shape, map, hidden, _, _ = self.model(input[:, t, :], hidden)
+        if sizes is None:
+            shape_loss = 0
+            if self.config.learn_shape:
+                shape_loss_mse = criterion_mse(pred_shape, shape_label[:, -1, :])#*10
+                # shape_loss_ce = criterion(pred_shape, shape_label[:, -1, :])
+                shape_loss += shape_loss_mse #+ shape_loss_ce
+                # shape_loss.backward(retain_graph=True)
+            return pred_num, map, shape_loss
+        shape_loss = [0 for _ in sizes]
+        if self.config.learn_shape:
+            pred_shape = pred_shape.split(sizes)
+            shape_label = shape_label[:, -1, :].split(sizes)
+            shape_loss = [criterion_mse(p, l) for p, l in zip(pred_shape, shape_label)]
+        return pred_num, map, shape_loss
+
     def get_map_loss(self, map, locations, noreduce=False):
         if noreduce:
             all_map_loss = self.criterion_bce_full_noreduce(map, locations)
             map_loss = all_map_loss.mean(axis=1)
-            map_loss_to_add = map_loss.sum().item()
+            map_loss_to_add = map_loss.sum().detach()
         else:
             map_loss = self.criterion_bce_full(map, locations)
-            map_loss_to_add = map_loss.item()
+            map_loss_to_add = map_loss.detach()
         return map_loss, map_loss_to_add
     
     def get_losses(self, pred_num, target, map, locations, ep, noreduce):
@@ -902,25 +974,39 @@ class Trainer():
 class TrainerDistract(Trainer):
     def __init__(self, model, loaders, test_xarray, config):
         super().__init__(model, loaders, test_xarray, config)
+        from datasets.dataset_generator import distractor_set
+        # Distractor counts of the datasets (see DatasetGenerator.get_schedule),
+        # the first index of the confusion matrices
+        self.distractor_set = sorted(distractor_set(config.challenge))
+        if test_xarray is not None:
+            self.check_distractors(test_xarray)
+
+    def check_distractors(self, test_xarray):
+        """Raise if a test set has distractor counts that aren't in
+        self.distractor_set, which would fall outside the confusion matrices."""
+        for name, data in test_xarray.items():
+            if 'numerosity_dist' not in data:
+                continue
+            counts = np.unique(data['numerosity_dist'].values)
+            unexpected = [int(d) for d in counts if d not in self.distractor_set]
+            if unexpected:
+                raise ValueError(f'Test set {name} has {unexpected} distractors, expected {self.distractor_set} for challenge {self.config.challenge}')
     
-    def update_confusion(self, target, pred, num_dist, confusion_matrix):
-        if confusion_matrix is None:
-            # confusion_matrix = np.zeros((3, self.nclasses-self.config.min_num, self.nclasses-self.config.min_num))
-            confusion_matrix = np.zeros((3, self.nclasses, self.nclasses))
-        
+    def update_confusion(self, target, pred, num_dist):
+        """Counts of (distractors, true, predicted) in one batch (float64),
+        added up on the device with index_add_. Distractor count d goes in
+        slot d - self.distractor_set[0], whichever counts are in the batch.
+        A count outside self.distractor_set makes index_add_ fail."""
+        n = self.nclasses
+        n_dist = len(self.distractor_set)
         # for dist in [0, 1, 2]:
-        for i, dist in enumerate(torch.unique(num_dist)):
-            ind = num_dist == dist
-            target_subset = target[ind]
-            pred_subset = pred[ind]
-            for j in range(target_subset.shape[0]):
-                label = target_subset[j]
-                # confusion_matrix[i, label-self.config.min_num, pred_subset[j]-self.config.min_num] += 1
-                confusion_matrix[i, label, pred_subset[j]] += 1
-        return confusion_matrix
+        dist_idx = num_dist.to(target.device).view(-1).long() - self.distractor_set[0]
+        flat = (dist_idx * n + target.view(-1)) * n + pred.view(-1)
+        counts = torch.zeros(n_dist * n * n, dtype=torch.float64, device=flat.device)
+        return counts.index_add_(0, flat, torch.ones_like(flat, dtype=torch.float64)).view(n_dist, n, n)
 
     def plot_confusion(self, confs):
-        distractor_set = [1, 2, 3]
+        distractor_set = self.distractor_set
         fig, axs = plt.subplots(len(distractor_set), 4, figsize=(19, 16))
         
         maxes = [mat.max() for mat in confs]
@@ -954,54 +1040,46 @@ class FeedForwardTrainer(Trainer):
         self.model.eval()
         noreduce = True
         config = self.config
-        n_correct = 0
-        correct_map = 0
-        epoch_loss = 0
-        num_epoch_loss = 0
-        count_map_epoch_loss = 0
-        confusion_matrix = None
-        test_results = pd.DataFrame()
+        metrics = EpochMetrics()
+        test_results = EpochResults(len(loader.dataset))
         # for i, (input, target, locations, shape_label, pass_count) in enumerate(loader):
         for i, (_, input, target, num_dist, all_loc, pass_count) in enumerate(loader):
             input = input.to(config.device)
-            batch_results = pd.DataFrame()
             pred_num, map, _ = self.model(input)
 
             losses, pred = self.get_losses(pred_num, target, map, all_loc, ep, noreduce)
             loss, num_loss, map_loss, map_loss_to_add = losses
             correct = pred.eq(target.view_as(pred))
             
-            batch_results['pass count'] = pass_count.detach().cpu().numpy()
-            batch_results['correct'] = correct.cpu().numpy()
-            batch_results['predicted'] = pred.detach().cpu().numpy()
-            batch_results['true'] = target.detach().cpu().numpy()
-            batch_results['loss'] = loss.detach().cpu().numpy()
+            batch_results = {'pass count': pass_count, 'correct': correct, 'predicted': pred,
+                             'true': target, 'loss': loss}
             try:
                 # Somehow before it was like just the first column was going
                 # into batch_results, so just map loss for the first out of
                 # nine location, instead of the average over all locations.
                 # batch_results['map loss'] = map_loss.mean(axis=1).detach().cpu().numpy()
                 # batch_results['map loss'] = map_loss.mean(axis=1).detach().cpu().numpy()
-                batch_results['full map loss'] = map_loss.detach().cpu().numpy()
+                batch_results['full map loss'] = map_loss.detach()
                 # batch_results['count map loss'] = count_map_loss.detach().cpu().numpy()
             except:
                 # batch_results['map loss'] = np.ones(loss.shape) * -1
-                batch_results['full map loss'] = np.ones(loss.shape) * -1
-                batch_results['count map loss'] = np.ones(loss.shape) * -1
-            batch_results['num loss'] = num_loss.detach().cpu().numpy()
+                batch_results['full map loss'] = -1.
+                batch_results['count map loss'] = -1.
+            batch_results['num loss'] = num_loss
             # batch_results['shape loss'] = shape_loss.detach().cpu().numpy() if self.config.learn_shape else -1
-            batch_results['epoch'] = ep
-            test_results = pd.concat((test_results, batch_results))
-
-            n_correct += correct.sum().item()
-            correct_map += (torch.round(torch.sigmoid(map)).eq(all_loc)*1.0).mean().item()
-            epoch_loss += loss.mean().item()
-            num_epoch_loss += num_loss.mean().item()
-            count_map_epoch_loss += map_loss_to_add
+            test_results.add(len(target), batch_results)
+
+            metrics.add('n_correct', correct.sum())
+            metrics.add('correct_map', (torch.round(torch.sigmoid(map)).eq(all_loc)*1.0).mean())
+            metrics.add('epoch_loss', loss.mean())
+            metrics.add('num_epoch_loss', num_loss.mean())
+            metrics.add('count_map_epoch_loss', map_loss_to_add)
             # class-specific analysis and confusion matrix
             if self.config.use_loss != 'map':
-                confusion_matrix = self.update_confusion(target, pred, num_dist, confusion_matrix)
+                metrics.add('confusion_matrix', self.update_confusion(target, pred, num_dist))
 
+        n_correct, correct_map, epoch_loss, num_epoch_loss, count_map_epoch_loss, confusion_matrix = metrics.totals(
+            'n_correct', 'correct_map', 'epoch_loss', 'num_epoch_loss', 'count_map_epoch_loss', 'confusion_matrix')
         # These two lines should be the same
         # map_epoch_loss / len(loader.dataset)
         # test_results['map loss'].mean()
@@ -1024,13 +1102,7 @@ class FeedForwardTrainer(Trainer):
     def train(self, loader, ep):
         self.model.train()
         noreduce = False
-        correct = 0
-        correct_map = 0
-        epoch_loss = 0
-        num_epoch_loss = 0
-        # map_epoch_loss = 0
-        count_map_epoch_loss = 0
-        shape_epoch_loss = 0
+        metrics = EpochMetrics()
         for i, (_, input, target, _, locations, _) in enumerate(loader):
             input = input.to(self.config.device)
             # assert all(locations.sum(dim=1) == target)
@@ -1041,15 +1113,17 @@ class FeedForwardTrainer(Trainer):
             loss.backward()
             self.optimizer.step()
 
-            correct += pred.eq(target.view_as(pred)).sum().item()
-            correct_map += (torch.round(torch.sigmoid(map)).eq(locations)*1.0).mean().item()
-            epoch_loss += loss.item()
-            num_epoch_loss += num_loss.item()
+            metrics.add('correct', pred.eq(target.view_as(pred)).sum())
+            metrics.add('correct_map', (torch.round(torch.sigmoid(map)).eq(locations)*1.0).mean())
+            metrics.add('epoch_loss', loss)
+            metrics.add('num_epoch_loss', num_loss)
             # if not isinstance(map_loss_to_add, int):
                 # map_loss_to_add = map_loss_to_add.item()
-            count_map_epoch_loss += map_loss_to_add
+            metrics.add('count_map_epoch_loss', map_loss_to_add)
             # count_map_epoch_loss += count_map_loss_to_add
         
+        correct, correct_map, epoch_loss, num_epoch_loss, count_map_epoch_loss = metrics.totals(
+            'correct', 'correct_map', 'epoch_loss', 'num_epoch_loss', 'count_map_epoch_loss')
         accuracy = 100. * (correct/len(loader.dataset))
         map_acc = 100 * (correct_map/(len(loader)))
         epoch_loss /= i+1
@@ -1083,18 +1157,13 @@ class RecurrentTrainer(Trainer):
         self.model.eval()
         noreduce = True
         config = self.config
-        n_correct = 0
-        epoch_loss = 0
-        num_epoch_loss = 0
-        count_map_epoch_loss = 0
-        confusion_matrix = None
-        test_results = pd.DataFrame()
+        metrics = EpochMetrics()
+        test_results = EpochResults(len(loader.dataset))
         # for i, (input, target, locations, shape_label, pass_count) in enumerate(loader):
         for i, (_, input, target, num_dist, all_loc, pass_count) in enumerate(loader):
             input = input.to(config.device)
             input_dim = input.shape[0]
             n_glimpses = config.n_glimpses
-            batch_results = pd.DataFrame()
             hidden = self.model.initHidden(input_dim)
             hidden = hidden.to(self.config.device)
 
@@ -1106,36 +1175,34 @@ class RecurrentTrainer(Trainer):
             loss, num_loss, map_loss, map_loss_to_add = losses
             correct = pred.eq(target.view_as(pred))
             
-            batch_results['pass count'] = pass_count.detach().cpu().numpy()
-            batch_results['correct'] = correct.cpu().numpy()
-            batch_results['predicted'] = pred.detach().cpu().numpy()
-            batch_results['true'] = target.detach().cpu().numpy()
-            batch_results['loss'] = loss.detach().cpu().numpy()
+            batch_results = {'pass count': pass_count, 'correct': correct, 'predicted': pred,
+                             'true': target, 'loss': loss}
             try:
                 # Somehow before it was like just the first column was going
                 # into batch_results, so just map loss for the first out of
                 # nine location, instead of the average over all locations.
                 # batch_results['map loss'] = map_loss.mean(axis=1).detach().cpu().numpy()
                 # batch_results['map loss'] = map_loss.mean(axis=1).detach().cpu().numpy()
-                batch_results['full map loss'] = map_loss.detach().cpu().numpy()
+                batch_results['full map loss'] = map_loss.detach()
                 # batch_results['count map loss'] = count_map_loss.detach().cpu().numpy()
             except:
                 # batch_results['map loss'] = np.ones(loss.shape) * -1
-                batch_results['full map loss'] = np.ones(loss.shape) * -1
-                batch_results['count map loss'] = np.ones(loss.shape) * -1
-            batch_results['num loss'] = num_loss.detach().cpu().numpy()
+                batch_results['full map loss'] = -1.
+                batch_results['count map loss'] = -1.
+            batch_results['num loss'] = num_loss
             # batch_results['shape loss'] = shape_loss.detach().cpu().numpy() if self.config.learn_shape else -1
-            batch_results['epoch'] = ep
-            test_results = pd.concat((test_results, batch_results))
+            test_results.add(len(target), batch_results)
 
-            n_correct += correct.sum().item()
-            epoch_loss += loss.mean().item()
-            num_epoch_loss += num_loss.mean().item()
-            count_map_epoch_loss += map_loss_to_add
+            metrics.add('n_correct', correct.sum())
+            metrics.add('epoch_loss', loss.mean())
+            metrics.add('num_epoch_loss', num_loss.mean())
+            metrics.add('count_map_epoch_loss', map_loss_to_add)
             # class-specific analysis and confusion matrix
             if self.config.use_loss != 'map':
-                confusion_matrix = self.update_confusion(target, pred, num_dist, confusion_matrix)
+                metrics.add('confusion_matrix', self.update_confusion(target, pred, num_dist))
 
+        n_correct, epoch_loss, num_epoch_loss, count_map_epoch_loss, confusion_matrix = metrics.totals(
+            'n_correct', 'epoch_loss', 'num_epoch_loss', 'count_map_epoch_loss', 'confusion_matrix')
         # These two lines should be the same
         # map_epoch_loss / len(loader.dataset)
         # test_results['map loss'].mean()
@@ -1157,12 +1224,7 @@ class RecurrentTrainer(Trainer):
     def train(self, loader, ep):
         self.model.train()
         noreduce = False
-        correct = 0
-        epoch_loss = 0
-        num_epoch_loss = 0
-        # map_epoch_loss = 0
-        count_map_epoch_loss = 0
-        shape_epoch_loss = 0
+        metrics = EpochMetrics()
         for i, (_, input, target, _, locations, _) in enumerate(loader):
             input = input.to(self.config.device)
             # assert all(locations.sum(dim=1) == target)
@@ -1179,14 +1241,16 @@ class RecurrentTrainer(Trainer):
             loss.backward()
             self.optimizer.step()
 
-            correct += pred.eq(target.view_as(pred)).sum().item()
-            epoch_loss += loss.item()
-            num_epoch_loss += num_loss.item()
+            metrics.add('correct', pred.eq(target.view_as(pred)).sum())
+            metrics.add('epoch_loss', loss)
+            metrics.add('num_epoch_loss', num_loss)
             # if not isinstance(map_loss_to_add, int):
                 # map_loss_to_add = map_loss_to_add.item()
-            count_map_epoch_loss += map_loss_to_add
+            metrics.add('count_map_epoch_loss', map_loss_to_add)
             # count_map_epoch_loss += count_map_loss_to_add
         
+        correct, epoch_loss, num_epoch_loss, count_map_epoch_loss = metrics.totals(
+            'correct', 'epoch_loss', 'num_epoch_loss', 'count_map_epoch_loss')
         accuracy = 100. * (correct/len(loader.dataset))
         epoch_loss /= i+1
         if self.scheduler is not None:
@@ -1212,69 +1276,63 @@ class TorchRNNTrainer(Trainer):
         self.model.eval()
         config = self.config
         device = config.device
-        n_correct = 0
-        epoch_loss = 0
-        num_epoch_loss = 0
-        count_map_epoch_loss = 0
-        shape_epoch_loss = 0
-        confusion_matrix = None
-        test_results = pd.DataFrame()
+        metrics = EpochMetrics()
+        test_results = EpochResults(len(loader.dataset))
         # for i, (input, target, locations, shape_label, pass_count) in enumerate(loader):
         for i, (_, xy, pix, target, num_dist, all_loc, shape_label, pass_count) in enumerate(loader):
             xy = xy.to(device)
             pix = pix.to(device)
             n_glimpses = xy.shape[1]
-            batch_results = pd.DataFrame()
             # hidden = self.model.initHidden(input_dim)
             # hidden = hidden.to(device)
             hidden = None
+            pred_num, pred_shape, map, hidden, _, _ = self.model.forward_sequence(xy, pix, hidden)
+            pred_num = pred_num[:, -1]
+            map = map[:, -1]
             for t in range(n_glimpses):
-                pred_num, pred_shape, map, hidden, _, _ = self.model(xy[:, t], pix[:, t, :], hidden)
                 if config.learn_shape:
-                    shape_loss_mse = criterion_mse(pred_shape, shape_label[:, t, :])#*10
-                    shape_loss_ce = criterion(pred_shape, shape_label[:, t, :])
+                    shape_loss_mse = criterion_mse(pred_shape[:, t], shape_label[:, t, :])#*10
+                    shape_loss_ce = criterion(pred_shape[:, t], shape_label[:, t, :])
                     shape_loss = shape_loss_mse#+ shape_loss_ce
-                    shape_epoch_loss += shape_loss.item()
+                    metrics.add('shape_epoch_loss', shape_loss)
                 else:
-                    shape_epoch_loss += -1
+                    metrics.add('shape_epoch_loss', -1)
             losses, pred = self.get_losses(pred_num, target, map, all_loc, ep, noreduce)
             # pred_num, pred_shape, map, _, _, _ = self.model(input)
             # losses, pred = self.get_losses(pred_num[:,-1,:], target, map[:, -1, :], all_loc, ep, noreduce)
             loss, num_loss, map_loss, map_loss_to_add = losses
             correct = pred.eq(target.view_as(pred))
-            batch_results['pass count'] = pass_count.detach().cpu().numpy()
-            batch_results['correct'] = correct.cpu().numpy()
-            batch_results['predicted'] = pred.detach().cpu().numpy()
-            batch_results['true'] = target.detach().cpu().numpy()
-            batch_results['loss'] = loss.detach().cpu().numpy()
+            batch_results = {'pass count': pass_count, 'correct': correct, 'predicted': pred,
+                             'true': target, 'loss': loss}
             try:
                 # Somehow before it was like just the first column was going
                 # into batch_results, so just map loss for the first out of
                 # nine location, instead of the average over all locations.
                 # batch_results['map loss'] = map_loss.mean(axis=1).detach().cpu().numpy()
                 # batch_results['map loss'] = map_loss.mean(axis=1).detach().cpu().numpy()
-                batch_results['full map loss'] = map_loss.detach().cpu().numpy()
+                batch_results['full map loss'] = map_loss.detach()
                 # batch_results['count map loss'] = count_map_loss.detach().cpu().numpy()
             except:
                 # batch_results['map loss'] = np.ones(loss.shape) * -1
-                batch_results['full map loss'] = np.ones(loss.shape) * -1
-                batch_results['count map loss'] = np.ones(loss.shape) * -1
-            batch_results['num loss'] = num_loss.detach().cpu().numpy()
+                batch_results['full map loss'] = -1.
+                batch_results['count map loss'] = -1.
+            batch_results['num loss'] = num_loss
             batch_results['shape loss'] = -1 #shape_loss.detach().cpu().numpy() if self.config.learn_shape else -1
-            batch_results['epoch'] = ep
-            test_results = pd.concat((test_results, batch_results))
+            test_results.add(len(target), batch_results)
 
-            n_correct += pred.eq(target.view_as(pred)).sum().item()
-            epoch_loss += loss.mean().item()
-            num_epoch_loss += num_loss.mean().item()
+            metrics.add('n_correct', pred.eq(target.view_as(pred)).sum())
+            metrics.add('epoch_loss', loss.mean())
+            metrics.add('num_epoch_loss', num_loss.mean())
             # if not isinstance(map_loss_to_add, int):
             #     map_loss_to_add = map_loss_to_add.item()
-            count_map_epoch_loss += map_loss_to_add
+            metrics.add('count_map_epoch_loss', map_loss_to_add)
             # class-specific analysis and confusion matrix
             # c = (pred.squeeze() == target)
             if self.config.use_loss != 'map':
-                confusion_matrix = self.update_confusion(target, pred, num_dist, confusion_matrix)
+                metrics.add('confusion_matrix', self.update_confusion(target, pred, num_dist))
 
+        n_correct, epoch_loss, num_epoch_loss, count_map_epoch_loss, shape_epoch_loss, confusion_matrix = metrics.totals(
+            'n_correct', 'epoch_loss', 'num_epoch_loss', 'count_map_epoch_loss', 'shape_epoch_loss', 'confusion_matrix')
         # These two lines should be the same
         # map_epoch_loss / len(loader.dataset)
         # test_results['map loss'].mean()
@@ -1298,13 +1356,7 @@ class TorchRNNTrainer(Trainer):
         self.model.train()
         noreduce = False
         config = self.config
-        correct = 0
-        correct_map = 0
-        epoch_loss = 0
-        num_epoch_loss = 0
-        # map_epoch_loss = 0
-        count_map_epoch_loss = 0
-        shape_epoch_loss = 0
+        metrics = EpochMetrics()
         accuracy=0
 
         for i, (_, xy, pix, target, num_dist, locations, shape_label, _) in enumerate(loader):
@@ -1326,16 +1378,18 @@ class TorchRNNTrainer(Trainer):
             # hidden = self.model.initHidden(input_dim)
             # hidden = hidden.to(config.device)
             hidden = None
+            pred_num, pred_shape, map, hidden, _, _ = self.model.forward_sequence(xy, pix, hidden)
+            pred_num = pred_num[:, -1]
+            map = map[:, -1]
             for t in range(n_glimpses):
-                pred_num, pred_shape, map, hidden, _, _ = self.model(xy[:, t], pix[:, t, :], hidden)
                 if config.learn_shape:
-                    shape_loss_mse = criterion_mse(pred_shape, shape_label[:, t, :])#*10
-                    shape_loss_ce = criterion(pred_shape, shape_label[:, t, :])
+                    shape_loss_mse = criterion_mse(pred_shape[:, t], shape_label[:, t, :])#*10
+                    shape_loss_ce = criterion(pred_shape[:, t], shape_label[:, t, :])
                     shape_loss = shape_loss_mse #+ shape_loss_ce
-                    shape_epoch_loss += shape_loss.item()
+                    metrics.add('shape_epoch_loss', shape_loss)
                     shape_loss.backward(retain_graph=True)
                 else:
-                    shape_epoch_loss += -1
+                    metrics.add('shape_epoch_loss', -1)
             losses, pred = self.get_losses(pred_num, target, map, locations, ep, noreduce)
             
             loss, num_loss, map_loss, map_loss_to_add = losses
@@ -1344,16 +1398,18 @@ class TorchRNNTrainer(Trainer):
             nn.utils.clip_grad_norm_(self.model.parameters(), 2)
             self.optimizer.step()
 
-            correct += pred.eq(target.view_as(pred)).sum().item()
-            correct_map += (torch.round(torch.sigmoid(map)).eq(locations)*1.0).mean().item()
+            metrics.add('correct', pred.eq(target.view_as(pred)).sum())
+            metrics.add('correct_map', (torch.round(torch.sigmoid(map)).eq(locations)*1.0).mean())
             
             
-            epoch_loss += loss.item()
-            num_epoch_loss += num_loss.item()
+            metrics.add('epoch_loss', loss)
+            metrics.add('num_epoch_loss', num_loss)
             # if not isinstance(map_loss_to_add, int):
                 # map_loss_to_add = map_loss_to_add.item()
-            count_map_epoch_loss += map_loss_to_add
+            metrics.add('count_map_epoch_loss', map_loss_to_add)
             # count_map_epoch_loss += count_map_loss_to_add 
+        correct, correct_map, epoch_loss, num_epoch_loss, count_map_epoch_loss, shape_epoch_loss = metrics.totals(
+            'correct', 'correct_map', 'epoch_loss', 'num_epoch_loss', 'count_map_epoch_loss', 'shape_epoch_loss')
         accuracy = 100. * (correct/len(loader.dataset))
         map_acc = 100 * (correct_map/(len(loader)))
         epoch_loss /= len(loader)
@@ -33,6 +33,10 @@ import torch.nn.functional as F
 import torch.optim as optim
 from torch.utils.data import random_split
 from utils import Timer
+from datasets.registry import dataset_key, lookup_dataset
+from loaders import TensorBatchLoader
+from datasets.quantization import packing
+from metrics import EpochMetrics
 
 # from ray import tune
 # from ray.tune import CLIReporter
@@ -271,10 +275,7 @@ def train_model(model, optimizer, scheduler, loaders, config, device):
 def train_one_epoch(train_loader, model, optimizer, which_loss, sort, device):
     """Iterate through all mini-batches for one epoch of training."""
     model.train()
-    mse_loss = 0
-    ce_loss = 0
-    tot_loss = 0
-    correct = 0
+    metrics = EpochMetrics()
     n = 0
     batch_n = 0
     for (input, target) in train_loader:
@@ -333,12 +334,13 @@ def train_one_epoch(train_loader, model, optimizer, which_loss, sort, device):
         else:
             argmax_labels = torch.argmax(target[:, TRAIN_SHAPES], 1)
             argmax_pred = torch.argmax(pred[:, TRAIN_SHAPES], 1)
-        correct += (argmax_pred == argmax_labels).sum().item()
+        metrics.add('correct', (argmax_pred == argmax_labels).sum())
         n += target.size(0)
-        mse_loss += mse.item()
+        metrics.add('mse_loss', mse)
         # bce_loss += bce.item()
-        ce_loss += ce.item()
-        tot_loss += total.item()
+        metrics.add('ce_loss', ce)
+        metrics.add('tot_loss', total)
+    correct, mse_loss, ce_loss, tot_loss = metrics.totals('correct', 'mse_loss', 'ce_loss', 'tot_loss')
     acc = 100 * (correct/n)
     mse_loss /= batch_n
     ce_loss /= batch_n
@@ -412,10 +414,7 @@ def train_one_epoch_logpolar(train_loader, model, optimizer, which_loss, sort):
 @torch.no_grad()
 def test(loader, model, which_loss, sort, device):
     model.eval()
-    mse_loss = 0
-    ce_loss = 0
-    tot_loss = 0
-    correct = 0
+    metrics = EpochMetrics()
     n = 0
     batch_n = 0
     for (input, target) in loader:
@@ -447,7 +446,7 @@ def test(loader, model, which_loss, sort, device):
         else:
             argmax_labels = torch.argmax(target[:, TRAIN_SHAPES], 1)
             argmax_pred = torch.argmax(pred[:, TRAIN_SHAPES], 1)
-        correct += (argmax_pred == argmax_labels).sum().item()
+        metrics.add('correct', (argmax_pred == argmax_labels).sum())
         # elif which_loss == 'bce':
         #     labels = torch.ceil(target[:, TRAIN_SHAPES])
         #     pred = torch.round(torch.sigmoid(pred[:, TRAIN_SHAPES]))
@@ -459,10 +458,11 @@ def test(loader, model, which_loss, sort, device):
         n += target.size(0)
         if which_loss == 'ce_noprob':
             ce = ce_noprob
-        mse_loss += mse.item()
+        metrics.add('mse_loss', mse)
         # bce_loss += bce.item()
-        ce_loss += ce.item()
-        tot_loss += total.item()
+        metrics.add('ce_loss', ce)
+        metrics.add('tot_loss', total)
+    correct, mse_loss, ce_loss, tot_loss = metrics.totals('correct', 'mse_loss', 'ce_loss', 'tot_loss')
     print(f'{pred.min()} --- {pred.max()}')
     acc = 100 * (correct/n)
     mse_loss /= batch_n
@@ -608,7 +608,16 @@ def get_dataframe(size, shapes_set, config, lums, solarize):
     # fname_gw = f'{home}/toysets/num{min_num}-{max_num}_nl-{noise_level}_{shapes}{samee}_{challenge}_grid{config.grid}_policy-{config.policy}_lum{lums}_{transform}12_{size}'
     fname_gw = f'{home}/datasets/image_sets/num{min_num}-{max_num}_nl-{noise_level}_{shapes}{samee}_{challenge}_grid{config.grid}_policy-{config.policy}_lum{lums}_{transform}{n_glimpses}_{size}'
     
-    if os.path.exists(fname_gw+'.nc'):
+    # Resolve through the registry index first (see datasets/registry.py)
+    transforms = [transform.rstrip('_'), 'polar']
+    keys = [dataset_key(min_num, max_num, noise_level, shapes, same, challenge, config.grid, config.policy, lums, tr, n_glimpses, size) for tr in transforms]
+    registered = [lookup_dataset(key) for key in keys]
+    registered = [fname for fname in registered if fname is not None]
+    if registered:
+        fname_gw = registered[0]
+        print(f'Loading registered dataset {fname_gw}.nc')
+        data = xr.open_dataset(fname_gw+'.nc')
+    elif os.path.exists(fname_gw+'.nc'):
         print(f'Loading saved dataset {fname_gw}.nc')
         # data = pd.read_pickle(fname_gw)
         data = xr.open_dataset(fname_gw+'.nc')
@@ -778,8 +787,17 @@ def get_dataset_xr(dataframe, config, device):
     # glimpse_array -= glimpse_array.min()
     # glimpse_array /= glimpse_array.max()
     # print(f'pixel range: {glimpse_array.min()}-{glimpse_array.max()}')
+    dequantize = None
+    if config.logpolar and config.policy != 'humanlike' and dataframe.attrs.get('quantization') is not None:
+        # Keep the pixels packed, the loader converts each batch to float32
+        with xr.open_dataset(dataframe.encoding['source'], mask_and_scale=False) as raw:
+            dequantize = {0: packing(raw['logpolar_pixels'])}
+            glimpse_array = raw['logpolar_pixels'].values
     dataframe.close()
-    shape_input = torch.tensor(glimpse_array).float()
+    if dequantize is None:
+        shape_input = torch.tensor(glimpse_array).float()
+    else:
+        shape_input = torch.from_numpy(glimpse_array)
 
     #     shape_input = torch.unsqueeze(shape_input, 1)  # 1 channel
     # else:
@@ -805,6 +823,7 @@ def get_dataset_xr(dataframe, config, device):
     #     dset = TensorDataset(image_input, xx_input, yy_input, shape_label)
     # else:
     dset = TensorDataset(shape_input, shape_label)
+    dset.dequantize = dequantize
     # loader = DataLoader(dset, batch_size=BATCH_SIZE, shuffle=True)
     
     return dset
@@ -1096,16 +1115,13 @@ def main():
 
     # Prepare datasets
     trainset, testset = load_data(config, device)
-    trainloader = DataLoader(
-        trainset,
-        batch_size=int(BATCH_SIZE),
-        shuffle=True,
-        num_workers=0)
-    testloader = DataLoader(
-        testset,
-        batch_size=int(BATCH_SIZE),
-        shuffle=True,
-        num_workers=0)
+    # trainloader = DataLoader(
+    #     trainset,
+    #     batch_size=int(BATCH_SIZE),
+    #     shuffle=True,
+    #     num_workers=0)
+    trainloader = TensorBatchLoader(trainset.tensors, int(BATCH_SIZE), dequantize=trainset.dequantize, compute_device=device)
+    testloader = TensorBatchLoader(testset.tensors, int(BATCH_SIZE), dequantize=testset.dequantize, compute_device=device)
     loaders = [trainloader, testloader]
 
     # Prepare model and optimizer